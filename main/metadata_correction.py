@@ -35,7 +35,8 @@ FEATURES:
 - Speed-based backlash (short moves: full, long moves: reduced)
 - Per-microscope configuration
 - Thermal state support (cold/preheated)
-- Jython-compatible (no NumPy, pure Python operations)
+- Batch API (correct_positions) for whole tile sequences with per-mask statistics
+- Jython-compatible (pure Python; NumPy is used for the batch API under CPython)
 
 USAGE:
 This module is imported by main.jy. Do not run it directly.
@@ -451,6 +452,172 @@ def apply_metadata_corrections(tile_x_um, tile_y_um, tile_index, tile_width_um,
     return x_corrected, y_corrected, state_name
 
 
+# ==============================================================================
+# BATCH CORRECTION (whole tile sequence at once)
+# ==============================================================================
+
+try:
+    import numpy as np  # CPython only; Jython falls back to plain lists
+except ImportError:
+    np = None
+
+MASK_FIRST = 8    # Bit 3: first-time axis activation
+MASK_START = 16   # First tile of a sequence (no movement, no offset)
+NUM_MASKS = 17
+
+MASK_STATES = {
+    0: 'left', 1: 'down_left', 2: 'right', 3: 'right_down',
+    4: 'sweep_left', 5: 'sweep_left_down', 6: 'sweep_right', 7: 'sweep_right_down',
+    9: 'first_down', 10: 'first_right', MASK_START: 'start',
+}
+
+
+def mask_state_name(mask):
+    """State name of a movement mask (same names as classify_movement)"""
+    return MASK_STATES.get(mask, 'unknown')
+
+
+def mask_offset_table(correction_matrix):
+    """
+    LUT offsets in pixels indexed by movement mask
+    
+    Returns a list of NUM_MASKS (x, y) pairs; masks without an entry in the
+    correction matrix (start, unknown) get (0, 0), like apply_metadata_corrections().
+    """
+    cm = correction_matrix
+    table = [(0.0, 0.0)] * NUM_MASKS
+    table[0] = (cm['offset_left_x'], cm['offset_left_y'])
+    table[1] = (cm['subseq_down_x_offset'], cm['subseq_down_y_offset'])
+    table[2] = (cm['offset_right_x'], cm['offset_right_y'])
+    table[3] = (cm['diag_right_down_x'], cm['diag_right_down_y'])
+    table[4] = table[0]  # Sweep left: no down component, left offsets
+    table[5] = (cm['sweep_left_down_x'], cm['sweep_left_down_y'])
+    table[6] = table[2]  # Sweep right: no down component, right offsets
+    table[7] = (cm['sweep_right_down_x'], cm['sweep_right_down_y'])
+    table[9] = (cm['first_down_x_offset'], cm['first_down_y_offset'])
+    table[10] = (cm['first_right_x_offset'], cm['first_right_y_offset'])
+    return table
+
+
+def classify_movements(xs_um, ys_um, correction_matrix):
+    """
+    Movement masks of a whole tile sequence in one pass
+    
+    Same rules as classify_movement() called tile by tile with one
+    movement_state: the first tile is MASK_START, the first plain right move
+    and the first non-sweep down move get bit 3.
+    
+    Returns a list of ints.
+    """
+    n = len(xs_um)
+    if n == 0:
+        return []
+    px_um = correction_matrix['pixel_size_um']
+    sweep_limit = correction_matrix['sweep_limit']
+    
+    if np is not None:
+        dx = np.diff(np.asarray(xs_um, dtype=float))
+        dy = np.diff(np.asarray(ys_um, dtype=float))
+        right = dx > 0.5
+        down = dy > 0.5
+        sweep = np.abs(dx / px_um) > sweep_limit
+        masks = (sweep.astype(int) << 2) | (right.astype(int) << 1) | down.astype(int)
+        for first in (right & ~down & ~sweep, down & ~sweep):
+            hits = np.flatnonzero(first)
+            if hits.size:
+                masks[hits[0]] |= MASK_FIRST
+        return [MASK_START] + masks.tolist()
+    
+    masks = [MASK_START]
+    first_right_done = first_down_done = False
+    for k in range(1, n):
+        dx = xs_um[k] - xs_um[k - 1]
+        dy = ys_um[k] - ys_um[k - 1]
+        right = dx > 0.5
+        down = dy > 0.5
+        sweep = abs(dx / px_um) > sweep_limit
+        mask = (int(sweep) << 2) | (int(right) << 1) | int(down)
+        if not first_right_done and right and not down and not sweep:
+            mask |= MASK_FIRST
+            first_right_done = True
+        elif not first_down_done and down and not sweep:
+            mask |= MASK_FIRST
+            first_down_done = True
+        masks.append(mask)
+    return masks
+
+
+def mask_statistics(masks, dx, dy):
+    """
+    Per-mask count, mean and RMS of displacements (dx, dy)
+    
+    Used for the applied corrections and for residuals (registered minus
+    predicted position), which are what the LUT offsets should be updated by.
+    
+    Returns dict mask -> {'state', 'count', 'mean_x', 'mean_y', 'rms'}.
+    """
+    acc = {}
+    for m, ex, ey in zip(masks, dx, dy):
+        a = acc.setdefault(m, [0, 0.0, 0.0, 0.0])
+        a[0] += 1
+        a[1] += ex
+        a[2] += ey
+        a[3] += ex * ex + ey * ey
+    stats = {}
+    for m, (count, sx, sy, sq) in acc.items():
+        stats[m] = {'state': mask_state_name(m), 'count': count, 'mean_x': sx / count,
+                    'mean_y': sy / count, 'rms': (sq / count) ** 0.5}
+    return stats
+
+
+def correct_positions(xs_um, ys_um, correction_matrix):
+    """
+    Batch version of apply_metadata_corrections() for all tiles of a file
+    
+    Classifies all moves at once, looks offsets up in mask_offset_table(),
+    and applies scale/skew, offsets and decaying thermal drift in bulk
+    (NumPy under CPython, lists under Jython). Results match calling
+    apply_metadata_corrections() tile by tile with a fresh movement_state.
+    
+    Returns dict with
+      'x', 'y':  corrected positions (um, lists)
+      'masks':   movement mask per tile
+      'states':  state name per tile ('passthrough' when disabled)
+      'stats':   mask_statistics() of the applied shift (um)
+    """
+    n = len(xs_um)
+    if not correction_matrix.get('enabled', False):
+        return {'x': list(xs_um), 'y': list(ys_um), 'masks': [MASK_START] * n,
+                'states': ['passthrough'] * n, 'stats': {}}
+    
+    cm = correction_matrix
+    masks = classify_movements(xs_um, ys_um, cm)
+    table = mask_offset_table(cm)
+    px_um = cm['pixel_size_um']
+    thermal_x, thermal_y = select_thermal_drift(cm, cm['thermal_factors']['thermal_load_factor'])
+    decay = cm['thermal_decay_rate']
+    
+    if np is not None:
+        x = np.asarray(xs_um, dtype=float)
+        y = np.asarray(ys_um, dtype=float)
+        offsets = np.asarray(table, dtype=float)[np.asarray(masks, dtype=int)] * px_um
+        drift = decay ** np.arange(n, dtype=float)
+        cx = cm['scale_x'] * x + cm['skew_xy'] * y + offsets[:, 0] + thermal_x * drift
+        cy = cm['skew_yx'] * x + cm['scale_y'] * y + offsets[:, 1] + thermal_y * drift
+        cx, cy = cx.tolist(), cy.tolist()
+    else:
+        cx, cy = [], []
+        for k in range(n):
+            x, y = xs_um[k], ys_um[k]
+            ox, oy = table[masks[k]]
+            drift = decay ** k
+            cx.append(cm['scale_x'] * x + cm['skew_xy'] * y + ox * px_um + thermal_x * drift)
+            cy.append(cm['skew_yx'] * x + cm['scale_y'] * y + oy * px_um + thermal_y * drift)
+    
+    stats = mask_statistics(masks, [cx[k] - xs_um[k] for k in range(n)], [cy[k] - ys_um[k] for k in range(n)])
+    return {'x': cx, 'y': cy, 'masks': masks, 'states': [mask_state_name(m) for m in masks], 'stats': stats}
+
+
 def visualize_grid_layout(tiles, grid_width, grid_height):
     """Generate ASCII visualization of tile grid for debugging"""
     grid = [['.' for _ in range(grid_width)] for _ in range(grid_height)]
@@ -0,0 +1,119 @@
+"""
+Job client for the CZI Stitcher daemon mode
+
+Submits stitching jobs to the spool folder served by a running Fiji
+(main.jy with "Serve stitching jobs" enabled) and reports their status.
+Needs stitcher_core.py next to it; runs under CPython 2.7/3 or Jython.
+
+USAGE:
+    python stitch_client.py SPOOL submit a.czi b.czi [--output DIR]
+                            [--param rb_radius=0 --param do_show=false] [--wait]
+    python stitch_client.py SPOOL status JOB_ID
+    python stitch_client.py SPOOL wait JOB_ID [--timeout SECONDS]
+
+SPOOL is <Processing Folder>/_jobs. Exit code 0 = done, 1 = failed,
+2 = still queued/running (status, or wait timed out).
+
+Note: Jython-compatible - pure ASCII, no encoding declaration.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stitcher_core as core
+
+
+def parse_param(text):
+    """name=value with value read as JSON (numbers, true/false), else as text"""
+    if '=' not in text:
+        raise argparse.ArgumentTypeError("expected name=value, got '{}'".format(text))
+    name, value = text.split('=', 1)
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name.strip(), value
+
+
+def describe(status):
+    if status is None:
+        return "unknown job"
+    parts = [status.get('state', '?')]
+    if status.get('file'):
+        parts.append("file {}/{} {}".format(status.get('file_index', 0), status.get('files', 0), status['file']))
+    if status.get('stage'):
+        parts.append("stage: {}".format(status['stage']))
+    if status.get('error'):
+        parts.append("error: {}".format(status['error']))
+    return ", ".join(parts)
+
+
+def exit_code(status):
+    state = (status or {}).get('state')
+    return 0 if state == 'done' else 1 if state in ('failed', None) else 2
+
+
+def wait(spool, job_id, timeout=None):
+    """Poll the job's status until it is done/failed or timeout seconds passed"""
+    start = time.time()
+    last = None
+    while True:
+        status = core.read_job_status(spool, job_id)
+        line = describe(status)
+        if line != last:
+            print("{}  {}".format(time.strftime("%H:%M:%S"), line))
+            last = line
+        if status is None or status.get('state') in ('done', 'failed'):
+            return status
+        if timeout is not None and time.time() - start > timeout:
+            return status
+        time.sleep(core.JOB_POLL_SECONDS)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Submit jobs to the CZI Stitcher daemon")
+    ap.add_argument('spool', help="spool folder (<Processing Folder>/_jobs)")
+    sub = ap.add_subparsers(dest='command')
+    p = sub.add_parser('submit', help="queue CZI files")
+    p.add_argument('files', nargs='+')
+    p.add_argument('--output', help="output folder (default: the daemon's)")
+    p.add_argument('--param', action='append', type=parse_param, default=[],
+                   help="override name=value, one of: " + ", ".join(sorted(core.JOB_PARAMS)))
+    p.add_argument('--wait', action='store_true', help="wait until the job has finished")
+    p.add_argument('--timeout', type=float)
+    p = sub.add_parser('status', help="show a job's status")
+    p.add_argument('job')
+    p = sub.add_parser('wait', help="wait for a job to finish")
+    p.add_argument('job')
+    p.add_argument('--timeout', type=float)
+    args = ap.parse_args(argv)
+
+    if args.command == 'submit':
+        missing = [f for f in args.files if not os.path.isfile(f)]
+        if missing:
+            ap.error("not found: " + ", ".join(missing))
+        try:
+            job_id = core.submit_job(args.spool, args.files, dict(args.param), args.output)
+        except ValueError as e:
+            ap.error(str(e))
+        print(job_id)
+        if not args.wait:
+            return 0
+        return exit_code(wait(args.spool, job_id, args.timeout))
+    if args.command == 'status':
+        status = core.read_job_status(args.spool, args.job)
+        print(describe(status))
+        return exit_code(status)
+    if args.command == 'wait':
+        return exit_code(wait(args.spool, args.job, args.timeout))
+    ap.print_help()
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
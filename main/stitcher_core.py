@@ -0,0 +1,2046 @@
+"""
+Stitcher Core Module for CZI Stitcher
+
+============================================================================
+FILE PLACEMENT: IMPORTANT!
+============================================================================
+This file MUST be in the SAME DIRECTORY as main.jy (next to
+metadata_correction.py).
+
+Correct placement:
+  /your/scripts/folder/main.jy                    <-- Main script
+  /your/scripts/folder/metadata_correction.py     <-- Correction module
+  /your/scripts/folder/stitcher_core.py           <-- This file
+============================================================================
+
+PURPOSE:
+Java-free core of the stitcher: OME-XML / global metadata parsing,
+TileConfiguration reading and writing, and the neighbor-constrained
+fallback for failed registrations.
+
+Nothing in this module imports ij, loci or java, so it runs unchanged under
+Jython (Fiji) and CPython. That makes the hot paths testable with pytest and
+measurable with tests/bench_stitcher_core.py without a microscope
+dataset.
+
+USAGE:
+main.jy imports this module and routes its log output through
+set_loggers(). Under CPython:
+
+    import stitcher_core
+    labels = stitcher_core._parse_stagelabels_from_xml(ome_xml)
+
+Note: Jython-compatible - pure ASCII, no encoding declaration.
+"""
+
+import os
+import re
+import codecs
+import math
+import struct
+import json
+import shutil
+import hashlib
+import tempfile
+import time
+import uuid
+from xml.sax.saxutils import escape as _xml_escape
+
+try:
+    _unicode = unicode
+except NameError:  # CPython 3
+    _unicode = str
+
+# ==============================================================================
+# LOGGING HOOKS
+# ==============================================================================
+
+def _noop(msg):
+    pass
+
+_log = _noop
+_logd = _noop
+
+def set_loggers(log_fn=None, debug_fn=None):
+    """Route core log output (main.jy passes its log() and logd())"""
+    global _log, _logd
+    _log = log_fn or _noop
+    _logd = debug_fn or _noop
+
+# ==============================================================================
+# TEXT HELPERS
+# ==============================================================================
+
+# Regular expressions (compiled once for performance)
+FLOAT_RE = re.compile(r"([-+]?\d*\.\d+|[-+]?\d+)(?:[eE][-+]?\d+)?")
+ATTR_RE = re.compile(r'([A-Za-z_:][-A-Za-z0-9_:.]*)="([^"]*)"')
+STAGELABEL_RE = re.compile(r'<(?:[A-Za-z0-9_]+:)?StageLabel\b([^>]*)/?>', re.IGNORECASE)
+_PIXELS_TAG_RE = re.compile(r'<Pixels\b([^>]*)>', re.IGNORECASE)
+_PHYSICAL_X_RE = re.compile(r'PhysicalSizeX\s*=\s*"([^"]+)"', re.IGNORECASE)
+_PHYSICAL_XUNIT_RE = re.compile(r'PhysicalSizeXUnit\s*=\s*"([^"]+)"', re.IGNORECASE)
+_PHYSICAL_Z_RE = re.compile(r'PhysicalSizeZ\s*=\s*"([^"]+)"', re.IGNORECASE)
+_PHYSICAL_ZUNIT_RE = re.compile(r'PhysicalSizeZUnit\s*=\s*"([^"]+)"', re.IGNORECASE)
+_CHANNEL_COLOR_RE = re.compile(r'<(?:[A-Za-z0-9_]+:)?Channel\b([^>]*)>', re.IGNORECASE)
+_IMAGE_RE = re.compile(r'<(?:[A-Za-z0-9_]+:)?Image\b[^>]*>(.*?)</(?:[A-Za-z0-9_]+:)?Image>',
+                       re.IGNORECASE | re.DOTALL)
+
+def to_text(o):
+    """Convert str/bytes/Java String to unicode text (never raises)"""
+    if o is None:
+        return None
+    if isinstance(o, _unicode):
+        return o
+    if isinstance(o, bytes):
+        return o.decode('utf-8', 'replace')
+    try:
+        return _unicode(o)
+    except Exception:
+        try:
+            return u"%s" % o
+        except Exception:
+            return u""
+
+def _map_keys(m):
+    """Keys of a Python dict or a java.util.Map (global metadata)"""
+    try:
+        return m.keySet()
+    except AttributeError:
+        return list(m.keys())
+
+def find_floats(s):
+    """Extract all float numbers from a string"""
+    if s is None:
+        return []
+    return [float(x) for x in FLOAT_RE.findall(u"{}".format(s))]
+
+# ==============================================================================
+# METADATA EXTRACTION
+# ==============================================================================
+
+def _parse_stagelabels_from_xml(xml):
+    """Parse all StageLabel tags from OME-XML (v31.16h proven pattern)"""
+    labels = []
+    if not xml:
+        return labels
+    xml = to_text(xml)
+    for m in STAGELABEL_RE.finditer(xml):
+        attrs = dict(ATTR_RE.findall(m.group(1)))
+        name = attrs.get('Name') or attrs.get('name') or ""
+        x_str = attrs.get('X') or attrs.get('x')
+        y_str = attrs.get('Y') or attrs.get('y')
+        z_str = attrs.get('Z') or attrs.get('z')
+        xunit = attrs.get('XUnit') or attrs.get('xUnit') or attrs.get('xunit') or attrs.get('Xunit') or ""
+        yunit = attrs.get('YUnit') or attrs.get('yUnit') or attrs.get('yunit') or ""
+        zunit = attrs.get('ZUnit') or attrs.get('zUnit') or attrs.get('zunit') or ""
+        try:
+            x = float(x_str) if x_str is not None else None
+        except ValueError:
+            x = None
+        try:
+            y = float(y_str) if y_str is not None else None
+        except ValueError:
+            y = None
+        try:
+            z = float(z_str) if z_str is not None else None
+        except ValueError:
+            z = None
+        labels.append({
+            'name': name, 'x': x, 'y': y, 'z': z,
+            'xunit': xunit, 'yunit': yunit, 'zunit': zunit,
+            'raw_attrs': attrs
+        })
+    return labels
+
+def _parse_pixels_physicalsize_from_xml(ome_xml):
+    """Parse pixel physical size from OME-XML (v31.16h)"""
+    if not ome_xml:
+        return None, ""
+    ome_xml = to_text(ome_xml)
+    m = _PIXELS_TAG_RE.search(ome_xml)
+    if m:
+        attrs = m.group(1)
+        mm = _PHYSICAL_X_RE.search(attrs)
+        px = float(mm.group(1)) if mm else None
+        um = _PHYSICAL_XUNIT_RE.search(attrs)
+        unit_mm = um.group(1) if um else ""
+        return px, unit_mm
+    mxx = _PHYSICAL_X_RE.search(ome_xml)
+    if mxx:
+        val = float(mxx.group(1))
+        um = _PHYSICAL_XUNIT_RE.search(ome_xml)
+        unit = um.group(1) if um else ""
+        return val, unit
+    return None, ""
+
+def parse_z_step_from_xml(ome_xml):
+    """Z step (um) of the first image in OME-XML, or None"""
+    if not ome_xml:
+        return None
+    m = _PIXELS_TAG_RE.search(to_text(ome_xml))
+    if not m:
+        return None
+    mz = _PHYSICAL_Z_RE.search(m.group(1))
+    if not mz:
+        return None
+    mu = _PHYSICAL_ZUNIT_RE.search(m.group(1))
+    try:
+        return _unit_to_um(float(mz.group(1)), mu.group(1) if mu else "")
+    except ValueError:
+        return None
+
+def _unit_to_um(value, unit):
+    """Convert various units to micrometers (v31.16h)"""
+    if value is None:
+        return None
+    if not unit:
+        return float(value)
+
+    # Ensure unit is unicode string to handle micro symbol safely
+    try:
+        u = to_text(unit).strip().lower()
+    except Exception:
+        return float(value)
+
+    # Replace all variants of micro symbol
+    u = u.replace('micro', 'um').replace(u'\u00b5', 'um').replace(u'\u03bc', 'um').replace(u'\u00c3\u0082\u00c2\u00b5', 'um')
+
+    if u in ('um', u'\u00b5m', u'\u03bcm', u'\u00c3\u0082\u00c2\u00b5m', 'm'):
+        # Check for meters vs micrometers
+        if u == 'm':
+            return float(value) * 1e6
+        return float(value)
+    if u == 'cm':
+        return float(value) * 1e4
+    if u == 'mm':
+        return float(value) * 1e3
+    if u in ('nm',):
+        return float(value) * 1e-3
+    if u in ('pm',):
+        return float(value) * 1e-6
+    if 'meter' in u or 'metre' in u:
+        if 'micrometer' in u or 'micron' in u:
+            return float(value)
+        return float(value) * 1e6
+    return float(value)
+
+def _pick_min_med(lst):
+    """Smallest and median plausible pixel size (0.01-50 um) from candidates"""
+    if not lst:
+        return None, None
+    lst = [c for c in lst if 0.01 <= c <= 50.0]
+    if not lst:
+        return None, None
+    lst.sort()
+    mid = len(lst) // 2
+    med = lst[mid] if len(lst) % 2 == 1 else 0.5 * (lst[mid - 1] + lst[mid])
+    return lst[0], med
+
+def _pixel_from_global_metadata(gMeta):
+    """Extract pixel size from global metadata (v31.16h fallback)
+
+    gMeta may be the reader's java.util.Hashtable or a plain dict
+    (e.g. SAMPLES/global_metadata.json).
+    """
+    if not gMeta:
+        return None, None
+    cams = []
+    generic = []
+    for k in _map_keys(gMeta):
+        try:
+            keystr = to_text(k)
+            val = to_text(gMeta.get(k))
+        except Exception:
+            continue
+        lkey = keystr.lower()
+        # Cheap key filter first: the float regex only runs on candidate keys
+        is_cam = "camerapixeldistance" in lkey
+        is_generic = ("pixel" in lkey and ("dist" in lkey or "size" in lkey)) or ("physicalsizex" in lkey)
+        if not (is_cam or is_generic):
+            continue
+        nums = [n for n in find_floats(val) if n > 0]
+        if not nums:
+            continue
+        if is_cam:
+            cams.extend(nums)
+        else:
+            generic.extend(nums)
+
+    cam_min, cam_med = _pick_min_med(cams)
+    gen_min, gen_med = _pick_min_med(generic)
+    if cam_med is not None:
+        return cam_min, cam_med
+    if gen_min is not None:
+        return gen_min, gen_med
+    return None, None
+
+def _parse_stage_labels_list_from_xml(ome_xml):
+    """Parse stage labels as simple list (v31.16h)"""
+    out = []
+    for L in _parse_stagelabels_from_xml(ome_xml):
+        out.append((L.get('name', ''), L.get('x', None), L.get('y', None), L.get('xunit', ''), L.get('yunit', '')))
+    return out
+
+def _ends_with_number(name, tail):
+    """Same as re.search(r'\\b<tail>$', name) without compiling a pattern per series"""
+    if not name.endswith(tail):
+        return False
+    if len(name) == len(tail):
+        return True
+    prev = name[-len(tail) - 1]
+    return not (prev.isalnum() or prev == '_')
+
+def try_ome_stage_labels_from_xml(xml, reader, series_index, labels=None):
+    """Try to get stage label position for specific series (v31.16h)
+
+    Pass pre-parsed `labels` when looking up many series of the same file;
+    otherwise the XML is re-parsed on every call.
+    """
+    if labels is None:
+        if not xml:
+            return None
+        labels = _parse_stagelabels_from_xml(xml)
+    if not labels:
+        return None
+    tail = "{}".format(series_index + 1)
+    tag = "#" + tail
+    for lab in labels:
+        nm = lab.get('name', '') or ""
+        if tag in nm or _ends_with_number(nm, tail):
+            return lab.get('x'), lab.get('y'), "StageLabel-Name-match"
+    try:
+        s_count = reader.getSeriesCount()
+    except Exception:
+        s_count = None
+    if s_count and len(labels) == s_count:
+        lab = labels[series_index]
+        return lab.get('x'), lab.get('y'), "StageLabel-order-map"
+    if len(labels) > 0 and series_index < len(labels):
+        lab = labels[series_index]
+        return lab.get('x'), lab.get('y'), "StageLabel-best-effort-index"
+    return None
+
+# ==============================================================================
+# LUT/COLOR DETECTION
+# ==============================================================================
+
+def _parse_color_attrs(blob):
+    """Channel Color values (signed RGBA ints) from Channel tags in blob"""
+    colors = []
+    channel_count = 0
+    for m in _CHANNEL_COLOR_RE.finditer(blob):
+        attrs = dict(ATTR_RE.findall(m.group(1)))
+        c = attrs.get('Color') or attrs.get('color')
+        _logd(u"  Channel {} raw color value: {}".format(channel_count, c))
+        if c:
+            try:
+                color_int = int(c)
+                colors.append(color_int)
+                _logd(u"    Parsed as signed int: {}".format(color_int))
+            except (ValueError, TypeError):
+                try:
+                    color_int = int(c, 0)
+                    colors.append(color_int)
+                    _logd(u"    Parsed with base detection: {}".format(color_int))
+                except (ValueError, TypeError) as e:
+                    _logd(u"    Failed to parse: {}".format(e))
+        channel_count += 1
+    return colors
+
+def parse_channel_colors_from_ome_xml(ome_xml):
+    """Parse channel colors from OME-XML (v36.5 fix: first image only, RGBA format)
+
+    Only extracts colors from the first <Image> element to avoid
+    duplicates when multiple images/series are present.
+    """
+    _logd(u"=== PARSING CHANNEL COLORS FROM OME-XML ===")
+    if not ome_xml:
+        _logd(u"  OME-XML is None, returning empty colors list")
+        return []
+    xml = to_text(ome_xml)
+    _logd(u"  OME-XML length: {} characters".format(len(xml)))
+
+    image_match = _IMAGE_RE.search(xml)
+    if image_match:
+        _logd(u"  Found <Image> tag, searching within first image only")
+        colors = _parse_color_attrs(image_match.group(1))
+    else:
+        _logd(u"  No <Image> tag found, searching all Channel tags (fallback)")
+        colors = _parse_color_attrs(xml)
+
+    _logd(u"  Total colors found: {}".format(len(colors)))
+    _logd(u"=== CHANNEL COLOR PARSING COMPLETE ===")
+    return colors
+
+def extract_channel_colors_from_gmeta(gMeta):
+    """Extract channel colors from global metadata (v36.5)
+
+    Looks for keys containing 'channel' and 'color' or similar patterns
+    that indicate color information per channel.
+    """
+    colors = []
+    if not gMeta:
+        return colors
+
+    color_map = {}
+    try:
+        for k in _map_keys(gMeta):
+            try:
+                keystr = to_text(k)
+                val = to_text(gMeta.get(k))
+            except (AttributeError, TypeError):
+                continue
+
+            lkey = keystr.lower()
+
+            # Look for keys that contain channel and color information
+            if ('channel' in lkey or 'ch' in lkey) and 'color' in lkey:
+                match = re.search(r'(\d+)', keystr)
+                if match:
+                    ch_idx = int(match.group(1))
+                    try:
+                        # Could be hex string or integer
+                        if val.startswith('#'):
+                            color_int = int(val[1:], 16)
+                        elif val.startswith('0x'):
+                            color_int = int(val, 16)
+                        else:
+                            color_int = int(val)
+                        color_map[ch_idx] = color_int
+                    except (ValueError, TypeError, AttributeError):
+                        pass
+    except Exception as e:
+        _log(u"extract_channel_colors_from_gmeta error: {}".format(e))
+
+    if color_map:
+        max_idx = max(color_map.keys())
+        for i in range(max_idx + 1):
+            if i in color_map:
+                colors.append(color_map[i])
+
+    return colors
+
+def _hex_to_rgb(hexstr):
+    """Convert hex string to RGB tuple (v31.16h)"""
+    if not hexstr:
+        return None
+    s = hexstr.strip()
+    if s.startswith('#'):
+        s = s[1:]
+    if len(s) == 6:
+        r = int(s[0:2], 16)
+        g = int(s[2:4], 16)
+        b = int(s[4:6], 16)
+    elif len(s) == 8:
+        r = int(s[2:4], 16)
+        g = int(s[4:6], 16)
+        b = int(s[6:8], 16)
+    else:
+        try:
+            r = int(s[-6:-4], 16)
+            g = int(s[-4:-2], 16)
+            b = int(s[-2:], 16)
+        except ValueError:
+            return None
+    return (r, g, b)
+
+def rgba_int_to_rgb(ci):
+    """Signed OME RGBA color int -> (R, G, B) (v36.5: RR GG BB AA byte order)"""
+    u = int(ci) & 0xFFFFFFFF
+    return ((u >> 24) & 0xFF, (u >> 16) & 0xFF, (u >> 8) & 0xFF)
+
+# ==============================================================================
+# STITCHING SUPPORT
+# ==============================================================================
+
+def suggest_stitcher_thresholds(tile_width_px, tile_height_px, avg_disp_px):
+    """Calculate suggested stitching thresholds (v31.16h)"""
+    ox = max(0.0, 1.0 - (avg_disp_px / float(tile_width_px)))
+    oy = max(0.0, 1.0 - (avg_disp_px / float(tile_height_px)))
+    avg_overlap = (ox + oy) / 2.0
+    if avg_overlap >= 0.6:
+        reg = 0.3
+    elif avg_overlap >= 0.4:
+        reg = 0.25
+    elif avg_overlap >= 0.2:
+        reg = 0.18
+    else:
+        reg = 0.12
+    max_disp = max(tile_width_px, tile_height_px) * 0.5
+    return {
+        'avg_overlap': avg_overlap,
+        'suggested_regression_threshold': reg,
+        'suggested_max_disp_px': max_disp
+    }
+
+# ==============================================================================
+# TILECONFIGURATION READ / WRITE
+# ==============================================================================
+
+def write_tile_configuration(path, entries, dim=2):
+    """Write a Grid/Collection TileConfiguration file
+
+    Args:
+        path: output file (written as UTF-8)
+        entries: list of (name, x, y) for dim=2 or (name, x, y, z) for dim=3
+        dim: 2 or 3
+    """
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        f.write(u"dim = {}\n".format(dim))
+        for e in entries:
+            if dim == 2:
+                f.write(u"{}; ; ({:.3f}, {:.3f})\n".format(e[0], e[1], e[2]))
+            else:
+                z = e[3] if len(e) > 3 else 0.0
+                f.write(u"{}; ; ({:.6f}, {:.6f}, {:.6f})\n".format(e[0], e[1], e[2], z))
+
+def extract_xy_from_parentheses(s):
+    """First two numbers inside the first (...) group of a layout line"""
+    try:
+        a = s.index('(')
+        b = s.index(')', a + 1)
+        inner = s[a + 1:b]
+        nums = []
+        for p in inner.split(','):
+            m = FLOAT_RE.search(p.strip())
+            if m:
+                nums.append(m.group(0))
+            if len(nums) >= 2:
+                break
+        if len(nums) >= 2:
+            return float(nums[0]), float(nums[1])
+    except ValueError:
+        pass
+    return None
+
+def read_tile_configuration(path):
+    """Parse a (registered) TileConfiguration into the tile position database
+
+    Returns dict name -> {'xy', 'correlation', 'failed', 'index',
+    'predicted_xy', 'movement_state', 'grid_pos'}. A tile other than the
+    first one registered at (0, 0) is flagged as a failed alignment.
+    """
+    with codecs.open(path, 'r', encoding='utf-8') as fr:
+        return parse_tile_configuration_lines(fr)
+
+def parse_tile_configuration_lines(lines):
+    """Line-level parser behind read_tile_configuration()"""
+    placements = []
+    for line in lines:
+        if ".tif" in line and "(" in line and ")" in line:
+            xy = extract_xy_from_parentheses(line)
+            if xy is None:
+                continue
+            name = line.split(";")[0].strip()
+
+            # Extract correlation score if present (format: "correlation (R)=0.8282859")
+            correlation = 1.0  # Default: assume success
+            if "correlation" in line and "=" in line:
+                try:
+                    corr_part = line[line.index("correlation"):line.index(")", line.index("correlation"))]
+                    correlation = float(corr_part.split("=")[1].strip())
+                except (ValueError, IndexError):
+                    pass
+            placements.append((name, xy[0], xy[1], correlation))
+    return tile_positions_from_placements(placements)
+
+def tile_positions_from_placements(placements):
+    """Tile position database from registered (name, x, y[, correlation]) tuples
+
+    Same structure as read_tile_configuration(), for registrations that
+    return positions directly instead of writing a layout file.
+    """
+    tile_positions = {}
+    for idx, p in enumerate(placements):
+        name, x, y = p[0], float(p[1]), float(p[2])
+        # Detect failed alignment: position (0.0, 0.0) indicates alignment failure
+        # Exception: Tile 0 is reference point and should be at (0, 0)
+        failed = (abs(x) < 0.01 and abs(y) < 0.01) and (idx > 0)
+        tile_positions[name] = {
+            'xy': (x, y),
+            'correlation': p[3] if len(p) > 3 else 1.0,
+            'failed': failed,
+            'index': idx,
+            'predicted_xy': None,
+            'movement_state': None,
+            'grid_pos': (0, 0)
+        }
+    return tile_positions
+
+# ==============================================================================
+# SUBSET SELECTION (ROI / Z-RANGE / CHANNELS)
+# ==============================================================================
+
+SUBSET_SIDECAR_SUFFIX = u".subset.txt"
+SUBSET_SPEC_HELP = u"roi=x0,y0,x1,y1; z=first-last; c=first-last"
+
+def _parse_index_range(value, key):
+    """'5' or '5-20' (1-based, inclusive) -> (first, last)"""
+    parts = [p.strip() for p in value.split('-')]
+    try:
+        if len(parts) == 1:
+            first = last = int(parts[0])
+        elif len(parts) == 2:
+            first, last = int(parts[0]), int(parts[1])
+        else:
+            raise ValueError(value)
+    except ValueError:
+        raise ValueError(u"{}: expected 'n' or 'first-last', got '{}'".format(key, value))
+    if first < 1 or last < first:
+        raise ValueError(u"{}: invalid range '{}' (1-based, first <= last)".format(key, value))
+    return first, last
+
+def parse_subset_spec(text):
+    """Parse a subset spec like 'roi=x0,y0,x1,y1; z=5-20; c=2'
+
+    roi is a stage-coordinate rectangle in um (any two opposite corners),
+    z and c are 1-based inclusive plane/channel ranges. Entries are separated
+    by ';' or new lines, '#' starts a comment.
+
+    Returns dict with keys 'roi', 'z', 'c' (None when not given), or None for
+    an empty spec. Raises ValueError on malformed input.
+    """
+    spec = {'roi': None, 'z': None, 'c': None}
+    found = False
+    for line in to_text(text or u"").splitlines():
+        line = line.split('#', 1)[0]
+        for item in line.split(';'):
+            item = item.strip()
+            if not item:
+                continue
+            if '=' not in item:
+                raise ValueError(u"Subset entry '{}' is not key=value".format(item))
+            key, value = [p.strip() for p in item.split('=', 1)]
+            key = key.lower()
+            if key == 'roi':
+                vals = find_floats(value)
+                if len(vals) != 4:
+                    raise ValueError(u"roi: expected x0,y0,x1,y1 in um, got '{}'".format(value))
+                spec['roi'] = (min(vals[0], vals[2]), min(vals[1], vals[3]),
+                               max(vals[0], vals[2]), max(vals[1], vals[3]))
+            elif key == 'z':
+                spec['z'] = _parse_index_range(value, key)
+            elif key in ('c', 'channels'):
+                spec['c'] = _parse_index_range(value, 'c')
+            else:
+                raise ValueError(u"Unknown subset key '{}' (use {})".format(key, SUBSET_SPEC_HELP))
+            found = True
+    return spec if found else None
+
+def merge_subset_specs(batch_spec, file_spec):
+    """Per-file entries override the batch-wide ones key by key"""
+    if not batch_spec:
+        return file_spec
+    if not file_spec:
+        return batch_spec
+    merged = dict(batch_spec)
+    for key, value in file_spec.items():
+        if value is not None:
+            merged[key] = value
+    return merged
+
+def subset_sidecar_path(czi_path):
+    """'<file>.subset.txt' belonging to a CZI file"""
+    return os.path.splitext(czi_path)[0] + SUBSET_SIDECAR_SUFFIX
+
+def copy_subset_sidecar(src, dst):
+    """Copy src's subset sidecar next to dst (a staged copy); True if there was one"""
+    sidecar = subset_sidecar_path(src)
+    if not os.path.isfile(sidecar):
+        return False
+    shutil.copyfile(sidecar, subset_sidecar_path(dst))
+    return True
+
+def load_subset_sidecar(czi_path):
+    """Read '<file>.subset.txt' next to a CZI file; None if there is none"""
+    path = subset_sidecar_path(czi_path)
+    try:
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            return parse_subset_spec(f.read())
+    except IOError:
+        return None
+
+def format_subset_spec(spec):
+    """Inverse of parse_subset_spec() for logging"""
+    if not spec:
+        return u"full"
+    parts = []
+    if spec.get('roi'):
+        parts.append(u"roi={:.1f},{:.1f},{:.1f},{:.1f}".format(*spec['roi']))
+    for key in ('z', 'c'):
+        if spec.get(key):
+            parts.append(u"{}={}-{}".format(key, spec[key][0], spec[key][1]))
+    return u"; ".join(parts) if parts else u"full"
+
+def select_tiles_in_roi(tiles, roi, tile_w_um, tile_h_um):
+    """Tiles whose footprint intersects a stage-coordinate ROI
+
+    Stage labels mark the tile centre, so each tile covers
+    x_s +/- tile_w_um / 2 and y_s +/- tile_h_um / 2. Input order is kept.
+    """
+    if not roi:
+        return list(tiles)
+    x0, y0, x1, y1 = roi
+    hw = tile_w_um / 2.0
+    hh = tile_h_um / 2.0
+    return [t for t in tiles
+            if t['x_s'] + hw > x0 and t['x_s'] - hw < x1 and t['y_s'] + hh > y0 and t['y_s'] - hh < y1]
+
+def clamp_plane_ranges(spec, size_z, size_c):
+    """0-based inclusive (z_begin, z_end, c_begin, c_end) for the reader
+
+    Ranges reaching past the stack are clamped to it (see clamped_plane_note);
+    ValueError when a range lies entirely outside. None when the full stack is
+    requested.
+    """
+    if not spec or (not spec.get('z') and not spec.get('c')):
+        return None
+    z0, z1 = spec.get('z') or (1, size_z)
+    c0, c1 = spec.get('c') or (1, size_c)
+    if z0 > size_z:
+        raise ValueError(u"z={}-{} is outside the stack ({} planes)".format(z0, z1, size_z))
+    if c0 > size_c:
+        raise ValueError(u"c={}-{} is outside the stack ({} channels)".format(c0, c1, size_c))
+    z0, z1 = max(1, min(z0, size_z)), max(1, min(z1, size_z))
+    c0, c1 = max(1, min(c0, size_c)), max(1, min(c1, size_c))
+    if (z0, z1, c0, c1) == (1, size_z, 1, size_c):
+        return None
+    return (z0 - 1, z1 - 1, c0 - 1, c1 - 1)
+
+def clamped_plane_note(spec, planes):
+    """Warning text when clamp_plane_ranges cut a requested range, else None"""
+    if not spec or not planes:
+        return None
+    cut = []
+    for key, (lo, hi) in (('z', planes[0:2]), ('c', planes[2:4])):
+        if spec.get(key) and tuple(spec[key]) != (lo + 1, hi + 1):
+            cut.append(u"{}={}-{} reads {}-{}".format(key, spec[key][0], spec[key][1], lo + 1, hi + 1))
+    return u", ".join(cut) if cut else None
+
+# ==============================================================================
+# CZI SUBBLOCK DIRECTORY
+# ==============================================================================
+# Minimal reader for the ZISRAW container: file header -> subblock directory
+# -> per-tile plane addresses. Pixel decoding stays on the Java side.
+
+CZI_SEGMENT_HEADER = 32  # 16-byte ASCII id + allocated size + used size
+CZI_PIXEL_TYPES = {0: 1, 1: 2, 2: 4}  # Gray8, Gray16, Gray32Float -> bytes per pixel
+CZI_COMPRESSION_NAMES = {0: u"uncompressed", 1: u"jpg", 2: u"lzw", 4: u"jpgxr", 5: u"zstd0", 6: u"zstd1"}
+
+def _czi_segment_id(buf):
+    return buf[:16].rstrip(b'\x00').decode('ascii', 'replace')
+
+def _read_czi_segment(f, pos, expected):
+    """Data of the segment at pos, checking its id"""
+    f.seek(pos)
+    head = f.read(CZI_SEGMENT_HEADER)
+    if len(head) < CZI_SEGMENT_HEADER or _czi_segment_id(head) != expected:
+        raise ValueError(u"no {} segment at offset {}".format(expected, pos))
+    used = struct.unpack('<q', head[24:32])[0]
+    return f.read(used)
+
+def parse_czi_directory_entry(buf, pos):
+    """One DirectoryEntryDV at buf[pos:] -> (entry, next_pos)"""
+    if buf[pos:pos + 2] != b'DV':
+        raise ValueError(u"unknown directory entry schema at {}".format(pos))
+    pixel_type, file_position, file_part, compression = struct.unpack('<iqii', buf[pos + 2:pos + 22])
+    pyramid = struct.unpack('<B', buf[pos + 22:pos + 23])[0]
+    dim_count = struct.unpack('<i', buf[pos + 28:pos + 32])[0]
+    dims = {}
+    p = pos + 32
+    for _ in range(dim_count):
+        name = buf[p:p + 4].rstrip(b'\x00 ').decode('ascii', 'replace')
+        start, size, _coord, stored = struct.unpack('<iifi', buf[p + 4:p + 20])
+        dims[name] = (start, size, stored)
+        p += 20
+    entry = {'pixel_type': pixel_type, 'file_position': file_position, 'file_part': file_part,
+             'compression': compression, 'pyramid': pyramid, 'dims': dims,
+             'entry_size': 32 + 20 * dim_count}
+    return entry, p
+
+def _czi_directory_position(header):
+    return struct.unpack('<q', header[52:60])[0]
+
+def czi_is_complete(path):
+    """True when the file header points at a fully written subblock directory
+
+    ZEN writes the directory last, so this rejects files still being acquired.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = _read_czi_segment(f, 0, u"ZISRAWFILE")
+            pos = _czi_directory_position(header)
+            if pos <= 0:
+                return False
+            f.seek(pos)
+            head = f.read(CZI_SEGMENT_HEADER)
+            if len(head) < CZI_SEGMENT_HEADER or _czi_segment_id(head) != u"ZISRAWDIRECTORY":
+                return False
+            used = struct.unpack('<q', head[24:32])[0]
+            return pos + CZI_SEGMENT_HEADER + used <= os.path.getsize(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return False
+
+def read_czi_directory(path):
+    """All subblock directory entries of a CZI file
+
+    Raises ValueError when the file is not a single-part ZISRAW container.
+    """
+    with open(path, 'rb') as f:
+        header = _read_czi_segment(f, 0, u"ZISRAWFILE")
+        file_part = struct.unpack('<i', header[48:52])[0]
+        if file_part != 0:
+            raise ValueError(u"multi-part CZI files are not supported")
+        data = _read_czi_segment(f, _czi_directory_position(header), u"ZISRAWDIRECTORY")
+    count = struct.unpack('<i', data[:4])[0]
+    entries = []
+    pos = 128
+    for _ in range(count):
+        entry, pos = parse_czi_directory_entry(data, pos)
+        entries.append(entry)
+    return entries
+
+CZI_SUBBLOCK_PREFIX = CZI_SEGMENT_HEADER + 16  # bytes to read at file_position for czi_subblock_data_range
+
+def czi_subblock_data_range(entry, prefix):
+    """(offset, length) of the pixel data of a subblock
+
+    prefix is the first CZI_SUBBLOCK_PREFIX bytes of the subblock segment.
+    Its header (sizes + own directory entry) is padded to at least 256
+    bytes and the XML metadata precedes the pixel data.
+    """
+    if _czi_segment_id(prefix) != u"ZISRAWSUBBLOCK":
+        raise ValueError(u"no subblock at offset {}".format(entry['file_position']))
+    metadata_size, _attachment_size, data_size = struct.unpack('<iiq', prefix[32:48])
+    header = max(256, 16 + entry['entry_size'])
+    return entry['file_position'] + CZI_SEGMENT_HEADER + header + metadata_size, data_size
+
+def czi_zstd1_header(data):
+    """(payload_offset, hilo) of a zstd1 subblock
+
+    The header is a size byte followed by chunks; chunk type 1 carries the
+    flag that 16-bit pixels were stored as a low-byte plane then a
+    high-byte plane.
+    """
+    size = bytearray(data[:1])[0]
+    head = bytearray(data[1:size])
+    hilo = False
+    p = 0
+    while p < len(head):
+        if head[p] == 1 and p + 1 < len(head):
+            hilo = bool(head[p + 1] & 1)
+            p += 2
+        else:
+            raise ValueError(u"unknown zstd1 header chunk {}".format(head[p]))
+    return size, hilo
+
+def czi_tile_planes(entries):
+    """Full-resolution planes grouped per tile in Bio-Formats series order
+
+    Returns a list (sorted by scene, then mosaic index) of dicts
+    (c, z, t) -> entry. Pyramid levels and downscaled subblocks are left out.
+    Raises ValueError on ambiguous layouts (duplicate planes).
+    """
+    tiles = {}
+    for e in entries:
+        d = e['dims']
+        if e['pyramid'] != 0 or any(d[k][1] != d[k][2] for k in ('X', 'Y') if k in d):
+            continue
+        key = (d.get('S', (0,))[0], d.get('M', (0,))[0])
+        plane = (d.get('C', (0,))[0], d.get('Z', (0,))[0], d.get('T', (0,))[0])
+        planes = tiles.setdefault(key, {})
+        if plane in planes:
+            raise ValueError(u"duplicate plane {} in tile {}".format(plane, key))
+        planes[plane] = e
+    return [tiles[k] for k in sorted(tiles)]
+
+# ==============================================================================
+# VIRTUAL MOSAIC
+# ==============================================================================
+# Instead of a fused stack, the registered tiles are kept as they are and
+# described by a BigDataViewer/BigStitcher dataset (spimreconstruction.filelist
+# loader, one view setup per tile and channel, translation + calibration
+# transforms) plus a JSON manifest with the same layout, voxel size and
+# channel colors. Viewers fuse on demand.
+
+MOSAIC_XML_SUFFIX = "_mosaic.xml"
+MOSAIC_MANIFEST_SUFFIX = "_mosaic.json"
+
+def color_to_hex(color):
+    """'#RRGGBB' of an OME signed RGBA color int"""
+    c = int(color) & 0xFFFFFFFF
+    return "#{:02X}{:02X}{:02X}".format((c >> 24) & 0xFF, (c >> 16) & 0xFF, (c >> 8) & 0xFF)
+
+def mosaic_manifest(tiles, size, voxel_um, colors=(), source=None):
+    """Layout of a virtual mosaic
+
+    tiles: (relative file, x px, y px, z slices) in fusion order.
+    size: (x, y, z, c) of every tile. voxel_um: (x, y, z).
+    """
+    nc = int(size[3])
+    return {
+        'version': 1,
+        'source': source,
+        'size': [int(v) for v in size],
+        'voxel_um': [float(v) for v in voxel_um],
+        'channels': [{'name': u"Channel {}".format(c + 1),
+                      'color': color_to_hex(colors[c]) if c < len(colors) else None} for c in range(nc)],
+        'tiles': [{'file': f.replace("\\", "/"), 'x': float(x), 'y': float(y), 'z': float(z)}
+                  for f, x, y, z in tiles],
+    }
+
+def _affine(m):
+    return u" ".join(u"{:.10g}".format(float(v)) for v in m)
+
+def bdv_mosaic_xml(manifest):
+    """BigDataViewer SpimData XML of a mosaic manifest (paths relative to the XML)"""
+    sx, sy, sz, nc = manifest['size']
+    vx, vy, vz = manifest['voxel_um']
+    ky, kz = vy / vx, vz / vx
+    tiles = manifest['tiles']
+    out = [u'<?xml version="1.0" encoding="UTF-8"?>', u'<SpimData version="0.2">',
+           u'  <BasePath type="relative">.</BasePath>', u'  <SequenceDescription>',
+           u'    <ImageLoader format="spimreconstruction.filelist">',
+           u'      <imglib2container>ArrayImgFactory</imglib2container>',
+           u'      <ZGrouped>false</ZGrouped>', u'      <files>']
+    for k, t in enumerate(tiles):
+        for c in range(nc):
+            out.append(u'        <FileMapping view_setup="{}" timepoint="0" series="0" channel="{}">'.format(
+                k * nc + c, c))
+            out.append(u'          <file type="relative">{}</file>'.format(_xml_escape(t['file'])))
+            out.append(u'        </FileMapping>')
+    out += [u'      </files>', u'    </ImageLoader>', u'    <ViewSetups>']
+    for k, t in enumerate(tiles):
+        for c in range(nc):
+            out += [u'      <ViewSetup>',
+                    u'        <id>{}</id>'.format(k * nc + c),
+                    u'        <name>{} {}</name>'.format(_xml_escape(os.path.basename(t['file'])),
+                                                       _xml_escape(manifest['channels'][c]['name'])),
+                    u'        <size>{} {} {}</size>'.format(sx, sy, sz),
+                    u'        <voxelSize>', u'          <unit>micrometer</unit>',
+                    u'          <size>{}</size>'.format(_affine((vx, vy, vz))), u'        </voxelSize>',
+                    u'        <attributes>',
+                    u'          <illumination>0</illumination>',
+                    u'          <channel>{}</channel>'.format(c),
+                    u'          <tile>{}</tile>'.format(k),
+                    u'          <angle>0</angle>',
+                    u'        </attributes>', u'      </ViewSetup>']
+    out += [u'      <Attributes name="illumination">',
+            u'        <Illumination><id>0</id><name>0</name></Illumination>', u'      </Attributes>',
+            u'      <Attributes name="channel">']
+    for c, ch in enumerate(manifest['channels']):
+        out.append(u'        <Channel><id>{}</id><name>{}</name></Channel>'.format(c, _xml_escape(ch['name'])))
+    out += [u'      </Attributes>', u'      <Attributes name="tile">']
+    for k, t in enumerate(tiles):
+        out.append(u'        <Tile><id>{}</id><name>{}</name><location>{}</location></Tile>'.format(
+            k, _xml_escape(os.path.basename(t['file'])), _affine((t['x'], t['y'] * ky, t['z'] * kz))))
+    out += [u'      </Attributes>', u'      <Attributes name="angle">',
+            u'        <Angle><id>0</id><name>0</name></Angle>', u'      </Attributes>',
+            u'    </ViewSetups>',
+            u'    <Timepoints type="range">', u'      <first>0</first>', u'      <last>0</last>',
+            u'    </Timepoints>', u'  </SequenceDescription>', u'  <ViewRegistrations>']
+    calibration = _affine((1, 0, 0, 0, 0, ky, 0, 0, 0, 0, kz, 0))
+    for k, t in enumerate(tiles):
+        shift = _affine((1, 0, 0, t['x'], 0, 1, 0, t['y'] * ky, 0, 0, 1, t['z'] * kz))
+        for c in range(nc):
+            out += [u'    <ViewRegistration timepoint="0" setup="{}">'.format(k * nc + c),
+                    u'      <ViewTransform type="affine">', u'        <Name>Stitching Transform</Name>',
+                    u'        <affine>{}</affine>'.format(shift), u'      </ViewTransform>',
+                    u'      <ViewTransform type="affine">', u'        <Name>calibration</Name>',
+                    u'        <affine>{}</affine>'.format(calibration), u'      </ViewTransform>',
+                    u'    </ViewRegistration>']
+    out += [u'  </ViewRegistrations>', u'  <ViewInterestPoints />', u'  <BoundingBoxes />',
+            u'  <PointSpreadFunctions />', u'  <StitchingResults />', u'  <IntensityAdjustments />',
+            u'</SpimData>', u'']
+    return u"\n".join(out)
+
+def write_virtual_mosaic(xml_path, manifest_path, manifest):
+    """Write the BigDataViewer XML and the JSON manifest of a mosaic"""
+    with codecs.open(xml_path, 'w', encoding='utf-8') as f:
+        f.write(bdv_mosaic_xml(manifest))
+    with codecs.open(manifest_path, 'w', encoding='utf-8') as f:
+        f.write(_unicode(json.dumps(manifest, indent=2, sort_keys=True)))
+
+def read_mosaic_manifest(path):
+    """Tile specs (absolute file, x, y, z) and the manifest, for fusing later"""
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    specs = [(os.path.join(base, *t['file'].split("/")), t['x'], t['y'], t['z']) for t in manifest['tiles']]
+    return specs, manifest
+
+# ==============================================================================
+# OUTPUT BIT DEPTH
+# ==============================================================================
+
+DISPLAY_SATURATION = 0.35  # Percent of pixels clipped (split over both ends), as Enhance Contrast
+
+def add_histogram(total, hist, lo, hi):
+    """Add bins lo..hi of one plane's histogram into total (in place)
+
+    Only the plane's occupied value range is touched, so streaming a
+    65536-bin histogram per plane stays cheap.
+    """
+    lo = max(0, int(lo))
+    hi = min(len(total) - 1, int(hi))
+    if hi >= lo:
+        total[lo:hi + 1] = [a + b for a, b in zip(total[lo:hi + 1], hist[lo:hi + 1])]
+
+def display_range(hist, saturated=DISPLAY_SATURATION):
+    """(lo, hi) bins clipping saturated/2 percent of the pixels at each end"""
+    threshold = sum(hist) * saturated / 200.0
+    lo, hi = 0, len(hist) - 1
+    count = 0
+    for i, n in enumerate(hist):
+        count += n
+        if n and count > threshold:
+            lo = i
+            break
+    count = 0
+    for i in range(len(hist) - 1, -1, -1):
+        count += hist[i]
+        if hist[i] and count > threshold:
+            hi = i
+            break
+    return lo, max(hi, lo + 1)
+
+def inverse_depth_mapping(lo, hi, levels=256):
+    """(offset, scale) so that original ~ offset + scale * reduced value
+
+    Matches ImageJ's display-range scaling (value - lo) * levels / (hi - lo + 1).
+    """
+    return float(lo), (hi - lo + 1) / float(levels)
+
+def depth_mapping_note(ranges, bits=8):
+    """Info lines recording the per-channel mapping of a reduced-depth file"""
+    lines = [u"BitDepthReduction = 16 -> {} bit, original = offset + scale * value".format(bits)]
+    for c, (lo, hi) in enumerate(ranges):
+        offset, scale = inverse_depth_mapping(lo, hi, 2 ** bits)
+        lines.append(u"BitDepthReduction C{} = range {}-{}, offset {:g}, scale {:g}".format(
+            c + 1, lo, hi, offset, scale))
+    return u"\n".join(lines)
+
+# ==============================================================================
+# TIME-LAPSE
+# ==============================================================================
+
+def reference_timepoint(requested, size_t):
+    """0-based registration frame from a 1-based request, clamped to the series"""
+    try:
+        t = int(requested) - 1
+    except (TypeError, ValueError):
+        t = 0
+    return max(0, min(t, int(size_t) - 1))
+
+def xyczt_plane_index(c, z, t, size_c, size_z):
+    """Plane number of (c, z, t) in XYCZT order (streamed writers)"""
+    return c + size_c * (z + size_z * t)
+
+# ==============================================================================
+# SCENES
+# ==============================================================================
+# Multi-scene CZIs (several sections on one slide) carry one
+# "Information|Image|S|Scene|..." block per scene in the global metadata,
+# suffixed " #1", " #2", ... by Bio-Formats when there is more than one.
+
+_SCENE_KEY = u"Information|Image|S|Scene|"
+_SCENE_SUFFIX_RE = re.compile(r'^(.*?)(?:\s+#(\d+))?$')
+
+def parse_scenes_from_gmeta(gMeta):
+    """Scene rectangles from global metadata
+
+    Returns list of {'index', 'name', 'center': (x, y), 'size': (w, h)}
+    (stage um) sorted by scene index; scenes without geometry are skipped.
+    """
+    if not gMeta:
+        return []
+    fields = {}
+    for k in _map_keys(gMeta):
+        ks = to_text(k)
+        if not ks.startswith(_SCENE_KEY):
+            continue
+        m = _SCENE_SUFFIX_RE.match(ks[len(_SCENE_KEY):])
+        fields.setdefault(m.group(2) or u"", {})[m.group(1)] = to_text(gMeta.get(k))
+    scenes = []
+    for suffix, f in fields.items():
+        center = find_floats(f.get(u"CenterPosition", u""))
+        size = find_floats(f.get(u"ContourSize", u""))
+        if len(center) < 2 or len(size) < 2:
+            continue
+        try:
+            index = int(f.get(u"Index", u"").strip())
+        except ValueError:
+            index = int(suffix) - 1 if suffix else 0
+        scenes.append({'index': index, 'name': f.get(u"Name") or u"Scene{}".format(index + 1),
+                       'center': (center[0], center[1]), 'size': (size[0], size[1])})
+    scenes.sort(key=lambda sc: sc['index'])
+    return scenes
+
+def group_tiles_by_scene(tiles, scenes):
+    """Split tiles into per-scene groups by stage position
+
+    A tile belongs to the scene whose contour contains its stage position,
+    or else to the scene with the nearest centre. Returns a list of
+    (scene, tiles) in scene order, acquisition order kept inside each group
+    and empty scenes left out. With fewer than two scenes everything is one
+    group with scene None.
+    """
+    if len(scenes) < 2:
+        return [(None, list(tiles))]
+    groups = dict((sc['index'], []) for sc in scenes)
+    for t in tiles:
+        best = None
+        best_d = None
+        for sc in scenes:
+            dx = abs(t['x_s'] - sc['center'][0])
+            dy = abs(t['y_s'] - sc['center'][1])
+            inside = dx <= sc['size'][0] / 2.0 and dy <= sc['size'][1] / 2.0
+            d = -1.0 if inside else dx * dx + dy * dy
+            if best_d is None or d < best_d:
+                best, best_d = sc, d
+            if inside:
+                break
+        groups[best['index']].append(t)
+    return [(sc, groups[sc['index']]) for sc in scenes if groups[sc['index']]]
+
+def safe_scene_name(name):
+    """Scene name usable in file names"""
+    cleaned = re.sub(r'[^A-Za-z0-9_.-]+', u"_", to_text(name)).strip(u"_.")
+    return cleaned or u"scene"
+
+# ==============================================================================
+# MEMORY BUDGET
+# ==============================================================================
+
+TILE_HEAP_FRACTION = 0.75  # Share of the free heap tile workers may fill
+TILE_OVERHEAD_FACTOR = 1.2  # ImagePlus/stack bookkeeping and importer buffers
+
+def estimate_tile_bytes(size_x, size_y, size_z, size_c, bytes_per_pixel, rolling_ball=False):
+    """Peak heap held by one TileWorker
+
+    The full z-stack, its MIP (one plane per channel) and, with rolling
+    ball subtraction, the float working copies of one plane.
+    """
+    plane = int(size_x) * int(size_y)
+    stack = plane * int(size_z) * int(size_c) * int(bytes_per_pixel)
+    mip = plane * int(size_c) * int(bytes_per_pixel)
+    work = plane * 4 * 3 if rolling_ball else 0
+    return int((stack + mip + work) * TILE_OVERHEAD_FACTOR)
+
+def tile_worker_budget(tile_bytes, max_memory, used_memory, max_workers, heap_fraction=TILE_HEAP_FRACTION):
+    """Number of tiles that fit in the heap at once
+
+    Returns (workers, budget_bytes): at least 1 and at most max_workers.
+    """
+    budget = max(0, int((max_memory - used_memory) * heap_fraction))
+    if tile_bytes <= 0:
+        return max(1, int(max_workers)), budget
+    fits = budget // int(tile_bytes)
+    return max(1, min(int(max_workers), int(fits))), budget
+
+# ==============================================================================
+# STAGE CACHE
+# ==============================================================================
+# Extracted tiles and registrations survive reruns. Every entry is one
+# directory named by the hash of everything its stage depends on; meta.json
+# is written last and its mtime is the entry's last use.
+
+CACHE_SAMPLE_BYTES = 1024 * 1024  # Head and tail bytes hashed into a file identity
+CACHE_META = "meta.json"
+
+def file_identity(path, sample_bytes=CACHE_SAMPLE_BYTES):
+    """Content fingerprint of a (huge) input file: size plus head and tail
+
+    Independent of path and mtime, so staged or copied inputs still hit.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha1(str(size).encode('ascii'))
+    with open(path, 'rb') as f:
+        h.update(f.read(sample_bytes))
+        if size > sample_bytes:
+            f.seek(max(sample_bytes, size - sample_bytes))
+            h.update(f.read(sample_bytes))
+    return h.hexdigest()
+
+def cache_key(*parts):
+    """Stable key of the parameters a stage depends on"""
+    blob = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+
+class StageCache(object):
+    """Directory-per-entry cache with LRU eviction under a byte budget"""
+
+    def __init__(self, root, budget_bytes):
+        self.root = root
+        self.budget_bytes = int(budget_bytes)
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def lookup(self, key):
+        """Metadata of a complete entry (marking it used), or None"""
+        path = os.path.join(self.root, key, CACHE_META)
+        try:
+            with codecs.open(path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return meta
+
+    def restore(self, key, name, dst_dir):
+        """Place file `name` of an entry into dst_dir; returns its new path"""
+        dst = os.path.join(dst_dir, name)
+        if os.path.exists(dst):
+            os.remove(dst)
+        _link_or_copy(os.path.join(self.root, key, name), dst)
+        return dst
+
+    def store(self, key, meta, files=()):
+        """Add an entry; a concurrent writer of the same key wins silently"""
+        tmp = tempfile.mkdtemp(prefix=key + ".", dir=self.root)
+        try:
+            for p in files:
+                _link_or_copy(p, os.path.join(tmp, os.path.basename(p)))
+            with codecs.open(os.path.join(tmp, CACHE_META), 'w', encoding='utf-8') as f:
+                f.write(_unicode(json.dumps(meta, sort_keys=True)))
+            os.rename(tmp, os.path.join(self.root, key))
+        except (IOError, OSError) as e:
+            _logd(u"  Cache store {} skipped: {}".format(key[:12], e))
+            shutil.rmtree(tmp, True)
+
+    def entries(self):
+        """(last_used, bytes, path) of every entry, oldest first
+
+        Leftovers without meta.json (interrupted stores) sort first.
+        """
+        out = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isdir(path):
+                continue
+            size = 0
+            for f in os.listdir(path):
+                size += os.path.getsize(os.path.join(path, f))
+            meta = os.path.join(path, CACHE_META)
+            out.append((os.path.getmtime(meta) if os.path.exists(meta) else 0.0, size, path))
+        out.sort()
+        return out
+
+    def evict(self):
+        """Drop least recently used entries until the cache fits its budget
+
+        Returns (entries removed, bytes freed).
+        """
+        entries = self.entries()
+        total = sum([e[1] for e in entries])
+        removed = freed = 0
+        for _, size, path in entries:
+            if total <= self.budget_bytes:
+                break
+            shutil.rmtree(path, True)
+            total -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+# ==============================================================================
+# WATCH FOLDER
+# ==============================================================================
+
+WATCH_POLL_SECONDS = 30  # Interval between input folder scans
+WATCH_SETTLE_SECONDS = 60  # Size and mtime must be unchanged this long
+
+def settled_files(state, listing, now, settle_seconds=WATCH_SETTLE_SECONDS):
+    """Files whose size and mtime have not changed for settle_seconds
+
+    listing: dict path -> (size, mtime) of the current scan. state is the
+    caller's dict path -> (size, mtime, unchanged_since), updated in place.
+    """
+    ready = []
+    for path, sig in listing.items():
+        prev = state.get(path)
+        if prev is None or (prev[0], prev[1]) != (sig[0], sig[1]):
+            state[path] = (sig[0], sig[1], now)
+        elif now - prev[2] >= settle_seconds:
+            ready.append(path)
+    for path in list(state):
+        if path not in listing:
+            del state[path]
+    return sorted(ready)
+
+# ==============================================================================
+# STITCHER CHOICES
+# ==============================================================================
+# Values of the dialog's choice fields. Kept here so job clients outside
+# Fiji can check them (job_overrides) before a job is queued.
+
+FUSION_METHODS = ["Linear Blending", "Max. Intensity", "Average", "Median"]
+FUSION_ENGINES = ["Built-in (shared weight maps)", "Grid/Collection plugin"]
+FUSION_ENGINE_BUILTIN = FUSION_ENGINES[0]
+
+# Handling of empty-glass tiles (classify_background_tiles)
+BACKGROUND_REGISTER = "Register all tiles"
+BACKGROUND_SKIP_REGISTRATION = "Skip registration"
+BACKGROUND_SKIP_FUSION = "Skip registration and fusion"
+BACKGROUND_MODES = [BACKGROUND_REGISTER, BACKGROUND_SKIP_REGISTRATION, BACKGROUND_SKIP_FUSION]
+
+OUTPUT_DEPTH_NATIVE = "Native"
+OUTPUT_DEPTH_8BIT = "8-bit (display range)"
+OUTPUT_DEPTHS = [OUTPUT_DEPTH_NATIVE, OUTPUT_DEPTH_8BIT]
+
+OUTPUT_FUSED = "Fused stack"
+OUTPUT_VIRTUAL = "Virtual mosaic (BigDataViewer XML, no fusion)"
+OUTPUT_BOTH = "Fused stack + virtual mosaic"
+OUTPUT_MODES = [OUTPUT_FUSED, OUTPUT_VIRTUAL, OUTPUT_BOTH]
+
+# ==============================================================================
+# JOB SPOOL
+# ==============================================================================
+# Daemon mode: a long-running Fiji takes jobs from a spool directory.
+# Clients drop <id>.json into queued/; the daemon claims a job by renaming
+# it into running/ (atomic, so several daemons may share one spool) and
+# moves it to done/ or failed/. status/<id>.json tracks file and stage.
+
+JOB_STATES = ('queued', 'running', 'done', 'failed')
+JOB_POLL_SECONDS = 2
+
+# Stitcher attributes a job may override, with their value kind (a list: one of its values)
+JOB_PARAMS = {
+    'fusion_method': FUSION_METHODS,
+    'fusion_engine': FUSION_ENGINES,
+    'rb_radius': 'int',
+    'reg_thresh': 'float',
+    'disp_thresh': 'float',
+    'axial_registration': 'bool',
+    'background_mode': BACKGROUND_MODES,
+    'reference_timepoint': 'int',
+    'auto_adjust': 'bool',
+    'corr_factor': 'float',
+    'do_save': 'bool',
+    'do_show': 'bool',
+    'output_depth': OUTPUT_DEPTHS,
+    'output_mode': OUTPUT_MODES,
+    'z_trim': 'int',
+    'subset': 'subset',
+}
+
+def init_job_spool(spool):
+    """Create the spool's state and status folders"""
+    for name in JOB_STATES + ('status',):
+        path = os.path.join(spool, name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+def _write_json_atomic(path, data):
+    """Readers never see a half-written file, even with concurrent writers"""
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    with codecs.open(tmp, 'w', encoding='utf-8') as f:
+        f.write(_unicode(json.dumps(data, sort_keys=True)))
+    try:
+        os.rename(tmp, path)
+    except OSError:  # Windows: rename does not replace
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        os.rename(tmp, path)
+
+def _read_json(path):
+    try:
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def job_overrides(params):
+    """Validated stitcher attribute overrides of a job's params
+
+    Raises ValueError on unknown names or values of the wrong kind.
+    """
+    out = {}
+    for name, value in (params or {}).items():
+        kind = JOB_PARAMS.get(name)
+        if kind is None:
+            raise ValueError(u"unknown parameter '{}'".format(name))
+        try:
+            if kind == 'bool':
+                if value not in (True, False, 0, 1):
+                    raise ValueError("expected true/false")
+                value = bool(value)
+            elif kind == 'int':
+                if isinstance(value, float) and value != int(value):
+                    raise ValueError("expected an integer")
+                value = int(value)
+            elif kind == 'float':
+                value = float(value)
+            elif kind == 'subset':
+                value = parse_subset_spec(value or u"")
+            elif isinstance(kind, list):
+                if value not in kind:
+                    raise ValueError(u"expected one of: " + u", ".join(u"'{}'".format(v) for v in kind))
+                value = _unicode(value)
+            else:
+                value = _unicode(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(u"parameter '{}': {}".format(name, e))
+        out[name] = value
+    return out
+
+_last_job_ms = 0
+
+def submit_job(spool, files, params=None, output=None):
+    """Queue a job; returns its id (ids sort in submission order)"""
+    job_overrides(params)
+    init_job_spool(spool)
+    global _last_job_ms
+    # Strictly increasing within this process: the random suffix alone would order same-ms jobs randomly
+    _last_job_ms = max(int(time.time() * 1000), _last_job_ms + 1)
+    job_id = "{:013d}-{}".format(_last_job_ms, uuid.uuid4().hex[:6])
+    job = {'id': job_id, 'files': [os.path.abspath(f) for f in files], 'params': params or {},
+           'output': os.path.abspath(output) if output else None, 'submitted': time.time()}
+    write_job_status(spool, job_id, {'state': 'queued', 'files': len(files)})
+    _write_json_atomic(os.path.join(spool, 'queued', job_id + '.json'), job)
+    return job_id
+
+def claim_next_job(spool):
+    """Oldest queued job moved to running/, as (id, job); None when idle"""
+    queued = os.path.join(spool, 'queued')
+    for name in sorted(os.listdir(queued)):
+        if not name.endswith('.json'):
+            continue
+        running = os.path.join(spool, 'running', name)
+        try:
+            os.rename(os.path.join(queued, name), running)
+        except OSError:
+            continue  # Claimed by another daemon
+        job = _read_json(running)
+        job_id = name[:-len('.json')]
+        if job is None:
+            finish_job(spool, job_id, 'failed')
+            write_job_status(spool, job_id, {'state': 'failed', 'error': u"unreadable job file"})
+            continue
+        return job_id, job
+    return None
+
+def finish_job(spool, job_id, state):
+    """Move a running job to done/ or failed/"""
+    name = job_id + '.json'
+    os.rename(os.path.join(spool, 'running', name), os.path.join(spool, state, name))
+
+def write_job_status(spool, job_id, status):
+    status = dict(status)
+    status['id'] = job_id
+    status['updated'] = time.time()
+    _write_json_atomic(os.path.join(spool, 'status', job_id + '.json'), status)
+
+def read_job_status(spool, job_id):
+    """Last status written for a job, or None"""
+    return _read_json(os.path.join(spool, 'status', job_id + '.json'))
+
+# ==============================================================================
+# TILE PIPELINE
+# ==============================================================================
+# Tiles flow read -> compute -> write on separate pools. Every
+# PIPELINE_TUNE_SECONDS the busiest stage is resized by hill climbing on
+# the measured tile throughput.
+
+PIPELINE_READ_THREADS = 2  # Start value: friendly to HDD/NAS, grown if reads are the bottleneck
+PIPELINE_WRITE_THREADS = 2
+PIPELINE_TUNE_SECONDS = 10.0
+PIPELINE_TOLERANCE = 0.05  # Relative throughput change treated as noise
+PIPELINE_STALL_SECONDS = 60.0  # All pools idle this long with tiles outstanding: give up on them
+
+def stage_utilisation(busy_seconds, threads, interval):
+    """Fraction of a pool's thread time spent working during interval"""
+    if interval <= 0:
+        return 0.0
+    return busy_seconds / (max(1, threads) * float(interval))
+
+def bottleneck_stage(utilisation):
+    """Stage with the highest utilisation (dict stage -> fraction)"""
+    return max(sorted(utilisation), key=lambda k: utilisation[k])
+
+def tune_pool_size(size, step, rate, prev_rate, lo, hi, tolerance=PIPELINE_TOLERANCE):
+    """One hill-climbing step for a pool: returns (new_size, step_taken)
+
+    step is the change made after the previous measurement (0 = none).
+    Keep going while throughput improves, undo a change that made it worse
+    and hold on a plateau; the first call probes one thread more.
+    """
+    if step == 0 or prev_rate is None:
+        step = 1
+    elif rate < prev_rate * (1.0 - tolerance):
+        step = -step
+    elif rate <= prev_rate * (1.0 + tolerance):
+        return size, 0
+    new = max(lo, min(hi, size + step))
+    return new, new - size
+
+# ==============================================================================
+# READ-AHEAD STAGING
+# ==============================================================================
+
+STAGING_MAX_AHEAD = 2  # Files staged beyond the one being processed
+STAGING_RESERVE_FACTOR = 3.0  # Scratch kept free for the current file's temp tiles, x its size
+
+def files_to_stage(sizes, free_bytes, reserve_bytes, max_ahead=STAGING_MAX_AHEAD):
+    """How many of the upcoming files fit on local scratch
+
+    sizes are in processing order; staging stops at the first file that
+    does not fit so copies are always used in order.
+    """
+    budget = free_bytes - reserve_bytes
+    n = 0
+    for size in sizes[:max_ahead]:
+        if size > budget:
+            break
+        budget -= size
+        n += 1
+    return n
+
+# ==============================================================================
+# BACKGROUND TILES
+# ==============================================================================
+# Tiles at section edges are mostly empty glass: they only add noise
+# correlations and (0,0) failures to registration. TileWorker summarises the
+# registration-channel MIP as a quantile ladder; the dimmest tile of a file
+# defines the glass level and noise, and a tile with almost no pixels above
+# that level is background.
+
+CONTENT_QUANTILE_STEP = 0.5  # Percent between stored quantiles (201 values)
+BACKGROUND_SIGMA = 5.0  # Foreground = brighter than glass level + SIGMA * glass noise
+BACKGROUND_MIN_FOREGROUND = 0.01  # Tiles with less foreground are background
+BACKGROUND_MIN_CONTENT = 0.10  # Some tile must have this much, or there is no glass to compare with
+
+def content_stats(hist, step=CONTENT_QUANTILE_STEP):
+    """Quantiles, variance and entropy (bits) of an intensity histogram
+
+    Returns None for an empty histogram.
+    """
+    total = float(sum(hist))
+    if total <= 0:
+        return None
+    s1 = s2 = entropy = 0.0
+    for v, n in enumerate(hist):
+        if n:
+            s1 += v * n
+            s2 += v * v * n
+            p = n / total
+            entropy -= p * math.log(p, 2)
+    mean = s1 / total
+    n_q = int(round(100.0 / step))
+    targets = [total * k / n_q for k in range(n_q + 1)]
+    quantiles = []
+    cum = 0.0
+    k = 0
+    for v, n in enumerate(hist):
+        cum += n
+        while k <= n_q and cum >= targets[k]:
+            quantiles.append(v)
+            k += 1
+    while len(quantiles) <= n_q:
+        quantiles.append(len(hist) - 1)
+    quantiles[0] = min(v for v, n in enumerate(hist) if n)
+    return {'quantiles': quantiles, 'mean': mean, 'variance': max(0.0, s2 / total - mean * mean),
+            'entropy': entropy}
+
+def _quantile(stats, q):
+    qs = stats['quantiles']
+    return qs[int(round(q / 100.0 * (len(qs) - 1)))]
+
+def foreground_fraction(stats, threshold):
+    """Fraction of pixels brighter than threshold, from the quantile ladder"""
+    qs = stats['quantiles']
+    if threshold < qs[0]:
+        return 1.0
+    if threshold >= qs[-1]:
+        return 0.0
+    n = len(qs) - 1
+    for k in range(n):
+        if qs[k] <= threshold < qs[k + 1]:
+            return 1.0 - (k + float(threshold - qs[k]) / (qs[k + 1] - qs[k])) / n
+    return 0.0
+
+def classify_background_tiles(stats_by_name, sigma=BACKGROUND_SIGMA, min_foreground=BACKGROUND_MIN_FOREGROUND,
+                              min_content=BACKGROUND_MIN_CONTENT):
+    """Names of tiles that are (nearly) empty glass
+
+    Returns (background names, glass threshold, foreground fraction by name).
+    Nothing is background unless some tile clearly has content and at least
+    two content tiles remain for registration.
+    """
+    stats = dict((n, st) for n, st in stats_by_name.items() if st)
+    if len(stats) < 3:
+        return set(), None, {}
+    glass = min(stats.values(), key=lambda st: _quantile(st, 50))
+    noise = max(1.0, (_quantile(glass, 75) - _quantile(glass, 25)) / 1.349)
+    threshold = _quantile(glass, 50) + sigma * noise
+    fg = dict((n, foreground_fraction(st, threshold)) for n, st in stats.items())
+    background = set(n for n, f in fg.items() if f < min_foreground)
+    if max(fg.values()) < min_content or len(stats_by_name) - len(background) < 2:
+        return set(), threshold, fg
+    return background, threshold, fg
+
+def place_background_tiles(tile_positions, entries, background):
+    """Add background tiles at their layout positions, shifted like the registered tiles
+
+    entries: (name, x, y) of every tile in file order, as laid out before
+    registration. The median shift of the successfully registered tiles is
+    applied, and indices are renumbered in file order. Returns (dx, dy).
+    """
+    layout = dict((e[0], (float(e[1]), float(e[2]))) for e in entries)
+    shifts = [(info['xy'][0] - layout[n][0], info['xy'][1] - layout[n][1])
+              for n, info in tile_positions.items() if not info['failed'] and n in layout]
+    dx = _median([d[0] for d in shifts]) if shifts else 0.0
+    dy = _median([d[1] for d in shifts]) if shifts else 0.0
+    for name in background:
+        x, y = layout[name]
+        tile_positions[name] = {
+            'xy': (x + dx, y + dy),
+            'correlation': 0.0,
+            'failed': False,
+            'index': 0,
+            'predicted_xy': None,
+            'movement_state': None,
+            'grid_pos': (0, 0),
+            'background': True
+        }
+    order = dict((e[0], k) for k, e in enumerate(entries))
+    for name, info in tile_positions.items():
+        info['index'] = order.get(name, len(order) + info['index'])
+    return dx, dy
+
+def _median(values):
+    v = sorted(values)
+    m = len(v) // 2
+    return v[m] if len(v) % 2 else 0.5 * (v[m - 1] + v[m])
+
+# ==============================================================================
+# NEIGHBOR-CONSTRAINED FALLBACK
+# ==============================================================================
+
+def attach_predictions(tile_positions, tiles, mip_by_series, ref_x, ref_y, px_um):
+    """Store metadata-predicted pixel positions for every registered tile
+
+    Args:
+        tile_positions: database from read_tile_configuration()
+        tiles: tile dicts with 'i', 'x_s', 'y_s' (stage um, corrected or raw)
+        mip_by_series: series index -> MIP file name
+        ref_x, ref_y: stage position of the reference tile (um)
+        px_um: effective pixel size (um)
+
+    Returns number of predictions stored.
+    """
+    stored = 0
+    for t in tiles:
+        mip_name = mip_by_series.get(t['i'])
+        if not mip_name:
+            _logd(u"[DEBUG] Tile idx {} - no matching MIP name found in res[]".format(t['i']))
+            continue
+        if mip_name not in tile_positions:
+            _logd(u"[DEBUG] Tile idx {} - MIP name '{}' not found in tile_positions".format(t['i'], mip_name))
+            continue
+        pred_x = (t['x_s'] - ref_x) / px_um
+        pred_y = (t['y_s'] - ref_y) / px_um
+        info = tile_positions[mip_name]
+        info['predicted_xy'] = (pred_x, pred_y)
+        info['movement_state'] = t.get('movement_state', 'UNKNOWN')
+        info['grid_pos'] = (t.get('x_grid', 0), t.get('y_grid', 0))
+        stored += 1
+        _logd(u"[DEBUG] Stored prediction for {} (idx {}): ({:.1f}, {:.1f})".format(
+            mip_name, t['i'], pred_x, pred_y))
+    return stored
+
+def _find_confident_neighbors(tile_positions, failed_idx, failed_grid, min_correlation=0.3):
+    """Confident neighbors of a failed tile as (name, info, distance)"""
+    neighbors = []
+    grid_known = failed_grid != (0, 0)
+    for cand_name, cand_info in tile_positions.items():
+        if cand_info['failed'] or cand_info['correlation'] < min_correlation:
+            continue
+        cand_grid = cand_info.get('grid_pos', (0, 0))
+        if grid_known and cand_grid != (0, 0):
+            grid_dist = abs(failed_grid[0] - cand_grid[0]) + abs(failed_grid[1] - cand_grid[1])
+            if 0 < grid_dist <= 2:
+                neighbors.append((cand_name, cand_info, grid_dist))
+        else:
+            idx_dist = abs(cand_info['index'] - failed_idx)
+            if 0 < idx_dist <= 3:
+                neighbors.append((cand_name, cand_info, max(idx_dist / 2.0, 1.0)))
+    return neighbors
+
+def _movement_compatibility(failed_move, neigh_move):
+    """Weight penalty for neighbors that moved in a different direction"""
+    move_compat = 1.0
+    if failed_move and neigh_move:
+        if ('RIGHT' in failed_move and 'RIGHT' not in neigh_move) or \
+           ('LEFT' in failed_move and 'LEFT' not in neigh_move):
+            move_compat *= 0.6
+        if 'DOWN' in failed_move and 'DOWN' not in neigh_move:
+            move_compat *= 0.6
+    return move_compat
+
+def recover_failed_tiles(tile_positions, verbose=True):
+    """Neighbor-constrained fallback for failed alignments (in place)
+
+    A failed tile is moved to its metadata prediction plus the inverse
+    distance weighted registration error of its confident neighbors
+    (R > 0.3). Without usable neighbors the pure prediction is used.
+
+    Returns (failed_names, recovered_count).
+    """
+    failed_tiles = [name for name, info in tile_positions.items() if info['failed']]
+    if not failed_tiles:
+        return failed_tiles, 0
+
+    _log(u"")
+    _log(u"=== NEIGHBOR-CONSTRAINED FALLBACK ===")
+    _log(u"  Detected {} failed tile alignment(s)".format(len(failed_tiles)))
+    _log(u"  Applying intelligent position recovery...")
+
+    for failed_name in failed_tiles:
+        failed_info = tile_positions[failed_name]
+        failed_idx = failed_info['index']
+        failed_grid = failed_info.get('grid_pos', (0, 0))
+
+        _log(u"")
+        _log(u"  [ANALYZING] Tile {} (idx {}, grid pos {})".format(failed_name, failed_idx, failed_grid))
+        _log(u"    Failed: {}, Correlation: {:.3f}".format(failed_info['failed'], failed_info['correlation']))
+        _log(u"    Has prediction: {}".format(failed_info['predicted_xy'] is not None))
+
+        neighbors = _find_confident_neighbors(tile_positions, failed_idx, failed_grid)
+        _log(u"    Found {} confident neighbors (R>0.3)".format(len(neighbors)))
+
+        if len(neighbors) == 0:
+            _log(u"    [NO NEIGHBORS] Cannot apply weighted correction")
+            if failed_info['predicted_xy']:
+                failed_info['xy'] = failed_info['predicted_xy']
+                failed_info['failed'] = False
+                _log(u"    [FALLBACK] Using pure metadata prediction: {}".format(failed_info['predicted_xy']))
+            else:
+                _log(u"    [FAILED] No prediction available - tile remains at (0,0)")
+            continue
+
+        if not failed_info['predicted_xy']:
+            _log(u"    [FAILED] No metadata prediction available - tile remains at (0,0)")
+            continue
+
+        pred_x, pred_y = failed_info['predicted_xy']
+        _log(u"    Metadata prediction: ({:.1f}, {:.1f})".format(pred_x, pred_y))
+
+        total_weight = 0.0
+        weighted_error_x = 0.0
+        weighted_error_y = 0.0
+        for neigh_name, neigh_info, distance in neighbors:
+            if not neigh_info['predicted_xy']:
+                _log(u"      Neighbor {} skipped (no prediction)".format(neigh_name))
+                continue
+            error_x = neigh_info['xy'][0] - neigh_info['predicted_xy'][0]
+            error_y = neigh_info['xy'][1] - neigh_info['predicted_xy'][1]
+            # Inverse distance weighting: w = (1/d^2) * correlation
+            weight = (1.0 / (distance * distance)) * neigh_info['correlation']
+            move_compat = _movement_compatibility(failed_info['movement_state'], neigh_info['movement_state'])
+            weight *= move_compat
+            if verbose:
+                _logd(u"      Neighbor {}: error=({:.1f},{:.1f}), dist={:.1f}, R={:.2f}, move_compat={:.2f}, weight={:.4f}".format(
+                    neigh_name, error_x, error_y, distance, neigh_info['correlation'], move_compat, weight))
+            weighted_error_x += weight * error_x
+            weighted_error_y += weight * error_y
+            total_weight += weight
+
+        if total_weight > 0:
+            avg_error_x = weighted_error_x / total_weight
+            avg_error_y = weighted_error_y / total_weight
+            _log(u"    Weighted error correction: ({:+.1f}, {:+.1f})".format(avg_error_x, avg_error_y))
+            # Trust weighted neighbors fully - having *some* fit >> no fit at (0,0)
+            corrected_x = pred_x + avg_error_x
+            corrected_y = pred_y + avg_error_y
+            failed_info['xy'] = (corrected_x, corrected_y)
+            failed_info['failed'] = False
+            avg_correlation = sum(n[1]['correlation'] for n in neighbors) / len(neighbors)
+            confidence = avg_correlation * 0.75
+            _log(u"    [SUCCESS] Final position: ({:.1f}, {:.1f}) [confidence: {:.2f}]".format(
+                corrected_x, corrected_y, confidence))
+        else:
+            failed_info['xy'] = failed_info['predicted_xy']
+            failed_info['failed'] = False
+            _log(u"    [FALLBACK] No weighted neighbors available, using pure prediction")
+
+    recovered_count = sum(1 for name in failed_tiles if not tile_positions[name]['failed'])
+    _log(u"")
+    _log(u"  FALLBACK SUMMARY:")
+    _log(u"    Total failed: {}".format(len(failed_tiles)))
+    _log(u"    Recovered: {}".format(recovered_count))
+    _log(u"    Still failed: {}".format(len(failed_tiles) - recovered_count))
+    _log(u"")
+    return failed_tiles, recovered_count
+
+def ordered_tile_names(tile_positions):
+    """Tile names in registration (file) order"""
+    return sorted(tile_positions.keys(), key=lambda n: tile_positions[n]['index'])
+
+# ==============================================================================
+# AXIAL (Z) REGISTRATION
+# ==============================================================================
+# TileWorker stores a compact axial profile per tile: for every cell of a
+# coarse grid, the mean intensity and mean edge strength of each z-plane.
+# Once the 2D positions are known, the cells inside a pair's overlap give
+# two comparable profiles whose best 1D alignment is the pair's z shift.
+
+AXIAL_PROFILE_GRID = 4
+AXIAL_MIN_SCORE = 0.5  # Minimum profile correlation for a usable pair
+AXIAL_MAX_RESIDUAL = 2.0  # Pairs disagreeing more with the global solve are dropped (slices)
+
+def profile_cell_rects(width, height, grid=AXIAL_PROFILE_GRID):
+    """(x, y, w, h) of the grid cells a tile profile is sampled on, row-major"""
+    rects = []
+    for gy in range(grid):
+        y0 = (height * gy) // grid
+        y1 = (height * (gy + 1)) // grid
+        for gx in range(grid):
+            x0 = (width * gx) // grid
+            x1 = (width * (gx + 1)) // grid
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+    return rects
+
+def overlap_cells(profile, offset_x, offset_y, ov):
+    """Indices of profile cells mostly inside overlap rectangle ov
+
+    offset_x/offset_y: tile origin in mosaic pixels, ov: (x0, y0, x1, y1)
+    in mosaic pixels.
+    """
+    cells = []
+    for k, (x, y, w, h) in enumerate(profile_cell_rects(profile['w'], profile['h'], profile['grid'])):
+        ix = min(ov[2], offset_x + x + w) - max(ov[0], offset_x + x)
+        iy = min(ov[3], offset_y + y + h) - max(ov[1], offset_y + y)
+        if ix > 0 and iy > 0 and ix * iy * 2 >= w * h:
+            cells.append(k)
+    return cells
+
+def combine_cells(profile, cells, key):
+    """Average per-plane profile over the given cells"""
+    if not cells:
+        return None
+    rows = [profile[key][k] for k in cells]
+    n = float(len(rows))
+    return [sum(r[z] for r in rows) / n for z in range(profile['nz'])]
+
+def _ncc(a, b):
+    """Normalized cross-correlation of two equally long sequences"""
+    n = len(a)
+    if n < 2:
+        return None
+    ma = sum(a) / float(n)
+    mb = sum(b) / float(n)
+    sab = saa = sbb = 0.0
+    for i in range(n):
+        da = a[i] - ma
+        db = b[i] - mb
+        sab += da * db
+        saa += da * da
+        sbb += db * db
+    if saa <= 0.0 or sbb <= 0.0:
+        return None
+    return sab / (saa * sbb) ** 0.5
+
+def axial_shift(prof_a, prof_b, max_shift, min_overlap=5):
+    """Best z shift d such that prof_b[k] matches prof_a[k + d]
+
+    Profiles may be one sequence or a list of sequences (e.g. sharpness
+    and intensity) that are scored together. Returns (d, score) with
+    sub-slice parabolic refinement, or (None, None) if nothing correlates.
+    """
+    if prof_a and not isinstance(prof_a[0], (list, tuple)):
+        prof_a, prof_b = [prof_a], [prof_b]
+    scores = {}
+    for d in range(-int(max_shift), int(max_shift) + 1):
+        total = 0.0
+        used = 0
+        for pa, pb in zip(prof_a, prof_b):
+            lo = max(0, -d)
+            hi = min(len(pb), len(pa) - d)
+            if hi - lo < min_overlap:
+                continue
+            c = _ncc(pa[lo + d:hi + d], pb[lo:hi])
+            if c is not None:
+                total += c
+                used += 1
+        if used:
+            scores[d] = total / used
+    if not scores:
+        return None, None
+    best = max(scores, key=lambda d: scores[d])
+    shift = float(best)
+    if (best - 1) in scores and (best + 1) in scores:
+        l, c, r = scores[best - 1], scores[best], scores[best + 1]
+        denom = l - 2.0 * c + r
+        if denom < 0.0:
+            shift += max(-0.5, min(0.5, 0.5 * (l - r) / denom))
+    return shift, scores[best]
+
+def pair_axial_shifts(placements, profiles, max_shift, min_score=AXIAL_MIN_SCORE):
+    """z shifts of all overlapping tile pairs
+
+    placements: list of (x_px, y_px) tile origins from 2D registration
+    profiles: per-tile axial profiles (None where unavailable), same order
+    Returns list of (i, j, d, score) with z_j - z_i = d.
+    """
+    pairs = []
+    n = len(placements)
+    for i in range(n):
+        pa = profiles[i]
+        if not pa:
+            continue
+        ax, ay = placements[i]
+        for j in range(i + 1, n):
+            pb = profiles[j]
+            if not pb:
+                continue
+            bx, by = placements[j]
+            ov = (max(ax, bx), max(ay, by), min(ax + pa['w'], bx + pb['w']), min(ay + pa['h'], by + pb['h']))
+            if ov[2] <= ov[0] or ov[3] <= ov[1]:
+                continue
+            cells_a = overlap_cells(pa, ax, ay, ov)
+            cells_b = overlap_cells(pb, bx, by, ov)
+            if not cells_a or not cells_b:
+                continue
+            d, score = axial_shift(
+                [combine_cells(pa, cells_a, 'sharp'), combine_cells(pa, cells_a, 'mean')],
+                [combine_cells(pb, cells_b, 'sharp'), combine_cells(pb, cells_b, 'mean')],
+                max_shift)
+            if d is not None and score >= min_score:
+                pairs.append((i, j, d, score))
+    return pairs
+
+def _relax_offsets(n, pairs, ref, iterations):
+    """Weighted least squares of z_j - z_i = d by Gauss-Seidel, z[ref] = 0"""
+    adj = [[] for _ in range(n)]
+    for i, j, d, w in pairs:
+        adj[i].append((j, -d, w))
+        adj[j].append((i, d, w))
+    z = [0.0] * n
+    for _ in range(iterations):
+        change = 0.0
+        for k in range(n):
+            if k == ref or not adj[k]:
+                continue
+            num = sum(w * (z[o] + d) for o, d, w in adj[k])
+            den = sum(w for _, _, w in adj[k])
+            new = num / den
+            change = max(change, abs(new - z[k]))
+            z[k] = new
+        if change < 1e-4:
+            break
+    return z
+
+def _connected(n, pairs, ref):
+    """Tiles linked to the reference tile through pairs"""
+    adj = [[] for _ in range(n)]
+    for i, j, _, _ in pairs:
+        adj[i].append(j)
+        adj[j].append(i)
+    seen = set([ref])
+    todo = [ref]
+    while todo:
+        k = todo.pop()
+        for o in adj[k]:
+            if o not in seen:
+                seen.add(o)
+                todo.append(o)
+    return seen
+
+def solve_z_offsets(n, pairs, ref=0, max_residual=AXIAL_MAX_RESIDUAL, iterations=500):
+    """Global per-tile z offsets (slices) from pairwise shifts
+
+    Pairs are weighted by their correlation score. Pairs that disagree with
+    the first solution by more than max_residual slices are dropped and the
+    system is solved again. Tiles not connected to the reference keep z = 0.
+
+    Returns (offsets, used_pairs).
+    """
+    if n == 0:
+        return [], []
+    z = _relax_offsets(n, pairs, ref, iterations)
+    kept = [p for p in pairs if abs(z[p[1]] - z[p[0]] - p[2]) <= max_residual]
+    if len(kept) != len(pairs):
+        _logd(u"  Axial solve: dropped {} inconsistent pair(s)".format(len(pairs) - len(kept)))
+        z = _relax_offsets(n, kept, ref, iterations)
+    linked = _connected(n, kept, ref)
+    return [z[k] if k in linked else 0.0 for k in range(n)], kept
+
+# ==============================================================================
+# Z-RANGE TRIMMING
+# ==============================================================================
+# Stacks are acquired with generous margins, so the top and bottom planes of
+# the whole mosaic are often empty. TileWorker records the mean and standard
+# deviation of every plane per channel; in fused coordinates the best contrast
+# any tile reaches on a plane says whether the plane holds structure. Planes
+# outside the first..last informative plane (plus a margin) are not fused.
+
+ZTRIM_MARGIN = 2  # Planes kept beyond the informative range on either side
+ZTRIM_MIN_CONTRAST = 0.1  # Informative: contrast rises this fraction from the floor towards the peak
+ZTRIM_KEEP_FRACTION = 0.5  # Planes with at least this fraction of the peak contrast are always kept
+
+def informative_z_range(plane_stds, z_offsets, depths, margin=ZTRIM_MARGIN,
+                        min_contrast=ZTRIM_MIN_CONTRAST, keep_fraction=ZTRIM_KEEP_FRACTION):
+    """First and last fused plane worth keeping (inclusive)
+
+    plane_stds: per tile a list (per channel) of per-plane standard
+    deviations, or None for tiles that should not be scored (background);
+    z_offsets: per tile z offset in slices; depths: per tile plane count.
+    Fused planes start at the smallest rounded offset, like the fusion.
+
+    Returns (z0, z1, n_slices), or None when no channel has any contrast.
+    """
+    shifts = [round_px(z) for z in z_offsets]
+    base = min(shifts)
+    n_slices = max([s - base + d for s, d in zip(shifts, depths)])
+    n_channels = max([len(sd) for sd in plane_stds if sd] or [0])
+    informative = [False] * n_slices
+    scored = False
+    for c in range(n_channels):
+        best = [None] * n_slices
+        for sd, s in zip(plane_stds, shifts):
+            if not sd or c >= len(sd):
+                continue
+            for z, v in enumerate(sd[c]):
+                k = s - base + z
+                if best[k] is None or v > best[k]:
+                    best[k] = v
+        values = [v for v in best if v is not None]
+        if not values:
+            continue
+        floor, peak = min(values), max(values)
+        if peak <= floor:
+            continue  # Flat channel: nothing to tell empty planes apart
+        scored = True
+        level = min(floor + min_contrast * (peak - floor), keep_fraction * peak)
+        for k, v in enumerate(best):
+            if v is not None and v >= level:
+                informative[k] = True
+    if not scored:
+        return None
+    kept = [k for k, v in enumerate(informative) if v]
+    return max(0, kept[0] - margin), min(n_slices - 1, kept[-1] + margin), n_slices
+
+def z_trim_note(z0, z1, n_slices):
+    """Info line recording which fused planes a trimmed stack holds"""
+    return u"ZTrim = planes {}-{} of {} kept".format(z0 + 1, z1 + 1, n_slices)
+
+# ==============================================================================
+# FUSION GEOMETRY
+# ==============================================================================
+
+def blend_profile(n, alpha):
+    """1D blending profile: distance to the nearest border, raised to alpha"""
+    return [float(min(i, n - 1 - i) + 1) ** alpha for i in range(n)]
+
+def round_px(v):
+    """Round a (sub)pixel position to the nearest whole pixel"""
+    return int((float(v) + 0.5) // 1)
@@ -0,0 +1,140 @@
+"""
+Micro-benchmarks for the Java-free stitcher core (main/stitcher_core.py).
+
+Scales the SAMPLES/ dataset up to microscope-run sizes (thousands of
+StageLabels, a replicated global metadata map, large TileConfigurations)
+and times the parsing, layout I/O and fallback paths.
+
+Run with: python bench_stitcher_core.py [--scale N] [--repeat N] (CPython)
+         or jython bench_stitcher_core.py (Jython/Fiji)
+
+Note: Jython-compatible - no encoding declaration or shebang.
+"""
+
+import sys
+import os
+import json
+import codecs
+import shutil
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+import stitcher_core as core
+
+SAMPLES = os.path.join(ROOT, "SAMPLES")
+
+
+# ============================================================================
+# SYNTHETIC INPUTS
+# ============================================================================
+
+def make_ome_xml(n_tiles):
+    """OME-XML with n_tiles Image/StageLabel blocks cloned from the sample"""
+    with codecs.open(os.path.join(SAMPLES, "OME.xml"), 'r', encoding='utf-8') as f:
+        xml = f.read()
+    a = xml.index('<Image ')
+    b = xml.rindex('</Image>') + len('</Image>')
+    first = xml[a:xml.index('</Image>', a) + len('</Image>')]
+    blocks = []
+    for i in range(n_tiles):
+        blk = first.replace('Scene position #0', 'Scene position #{}'.format(i))
+        blk = blk.replace('X="44573.391"', 'X="{:.3f}"'.format(44573.391 + 350.0 * (i % 50)))
+        blk = blk.replace('Y="46307.761"', 'Y="{:.3f}"'.format(46307.761 + 300.0 * (i // 50)))
+        blocks.append(blk)
+    return xml[:a] + u"".join(blocks) + xml[b:]
+
+
+def make_global_metadata(copies):
+    """Global metadata map with every key replicated `copies` times"""
+    with open(os.path.join(SAMPLES, "global_metadata.json")) as f:
+        base = json.load(f)
+    out = {}
+    for c in range(copies):
+        for k, v in base.items():
+            out[u"{} #{}".format(k, c)] = v
+    return out
+
+
+def make_layout(n_tiles, fail_every=7):
+    """TileConfiguration entries on a 50-column grid, every n-th one failed"""
+    entries = []
+    for i in range(n_tiles):
+        if i and i % fail_every == 0:
+            entries.append(("S{:04d}.tif".format(i), 0.0, 0.0))
+        else:
+            entries.append(("S{:04d}.tif".format(i), 1014.3 * (i % 50) + 2.5, 858.1 * (i // 50) - 1.5))
+    return entries
+
+
+# ============================================================================
+# BENCHMARKS
+# ============================================================================
+
+def timed(label, fn, repeat):
+    """Best-of-`repeat` wall time of fn() in milliseconds"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        t0 = time.time()
+        result = fn()
+        dt = (time.time() - t0) * 1000.0
+        best = dt if best is None else min(best, dt)
+    print("  {:<44s} {:>10.2f} ms".format(label, best))
+    return result
+
+
+def run_benchmarks(scale=20, repeat=3):
+    """Run all benchmarks at `scale` x the sample dataset"""
+    n_tiles = 9 * scale
+    print("\n" + "="*70)
+    print("STITCHER CORE - BENCHMARKS ({} tiles, best of {})".format(n_tiles, repeat))
+    print("="*70)
+
+    xml = make_ome_xml(n_tiles)
+    gmeta = make_global_metadata(max(1, scale // 10))
+    print("  OME-XML: {} chars, global metadata: {} keys".format(len(xml), len(gmeta)))
+
+    labels = timed("parse StageLabels", lambda: core._parse_stagelabels_from_xml(xml), repeat)
+    timed("pixel size from OME-XML", lambda: core._parse_pixels_physicalsize_from_xml(xml), repeat)
+    timed("channel colors from OME-XML", lambda: core.parse_channel_colors_from_ome_xml(xml), repeat)
+    timed("pixel size from global metadata", lambda: core._pixel_from_global_metadata(gmeta), repeat)
+    timed("channel colors from global metadata", lambda: core.extract_channel_colors_from_gmeta(gmeta), repeat)
+    timed("stage lookup per series (pre-parsed)",
+          lambda: [core.try_ome_stage_labels_from_xml(xml, None, s, labels=labels) for s in range(n_tiles)],
+          repeat)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "TileConfiguration.registered.txt")
+        entries = make_layout(n_tiles)
+        timed("write TileConfiguration", lambda: core.write_tile_configuration(path, entries, dim=2), repeat)
+        timed("read TileConfiguration", lambda: core.read_tile_configuration(path), repeat)
+
+        stage = [{'i': i, 'x_s': 350.0 * (i % 50), 'y_s': 300.0 * (i // 50)} for i in range(n_tiles)]
+        mip_by_series = dict((i, e[0]) for i, e in enumerate(entries))
+
+        def fallback():
+            tiles = core.read_tile_configuration(path)
+            core.attach_predictions(tiles, stage, mip_by_series, 0.0, 0.0, 0.345)
+            return core.recover_failed_tiles(tiles, verbose=False)
+
+        failed, recovered = timed("neighbor fallback (read + predict + recover)", fallback, repeat)
+        print("  fallback: {} failed, {} recovered".format(len(failed), recovered))
+    finally:
+        shutil.rmtree(tmp)
+    print("="*70)
+
+
+if __name__ == '__main__':
+    scale = 20
+    repeat = 3
+    args = sys.argv[1:]
+    for i, a in enumerate(args):
+        if a == '--scale' and i + 1 < len(args):
+            scale = int(args[i + 1])
+        elif a == '--repeat' and i + 1 < len(args):
+            repeat = int(args[i + 1])
+    run_benchmarks(scale, repeat)
@@ -1,8 +1,8 @@
 """
 Test suite for metadata correction system core functionality.
 
-Tests the state machine, correction application, and debug visualization
-without requiring actual CZI files or Fiji environment.
+Tests the state machine, correction application, and debug visualization of
+main/metadata_correction.py without requiring actual CZI files or Fiji environment.
 
 Run with: python test_metadata_correction.py (CPython)
          or jython test_metadata_correction.py (Jython/Fiji)
@@ -13,245 +13,41 @@ Note: Jython-compatible - no encoding declaration or shebang.
 import sys
 import os
 
-# Add parent directory to path for imports
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main/ holds the modules under test
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main"))
 
-# ============================================================================
-# CORE FUNCTIONALITY IMPLEMENTATION (for testing)
-# ============================================================================
+import metadata_correction as mc
 
-class MatrixOps:
-    """Pure Python matrix operations for Jython compatibility"""
-    
-    @staticmethod
-    def apply_2d_transform(x, y, scale_x, scale_y, skew_xy, skew_yx, offset_x, offset_y):
-        """Apply 2D affine transformation to point (x, y)"""
-        x_prime = scale_x * x + skew_xy * y + offset_x
-        y_prime = skew_yx * x + scale_y * y + offset_y
-        return x_prime, y_prime
-    
-    @staticmethod
-    def interpolate(old_value, new_value, learning_rate):
-        """Exponential moving average for learning"""
-        return old_value * (1.0 - learning_rate) + new_value * learning_rate
-
-
-def create_default_correction_matrix(microscope_id='default'):
-    """Create a default correction matrix"""
-    return {
-        'microscope_id': microscope_id,
-        'thermal_state': 'unknown',
-        'thermal_factors': {
-            'z_stack_height_um': 0.0,
-            'num_channels': 1,
-            'num_tiles': 0,
-            'thermal_load_factor': 0.0
-        },
-        'backlash_x_left': 0.0,
-        'backlash_x_right': 0.0,
-        'backlash_y_down': 0.0,
-        'backlash_long_x_left': 0.0,
-        'backlash_long_x_right': 0.0,
-        'long_move_threshold_x': 2.0,
-        'scale_x': 1.0,
-        'scale_y': 1.0,
-        'skew_xy': 0.0,
-        'skew_yx': 0.0,
-        'thermal_drift_x_cold': 0.0,
-        'thermal_drift_y_cold': 0.0,
-        'thermal_drift_x_preheated': 0.0,
-        'thermal_drift_y_preheated': 0.0,
-        'thermal_decay_rate': 0.95,
-        'first_down_y_offset': 0.0,
-        'first_down_confidence': 0.0,
-        'last_updated': '',
-        'num_sessions': 0,
-        'learning_rate': 0.3
-    }
+PX_UM = 0.345  # Default pixel size of the correction matrix
+STEP_X = 377.0  # Typical tile spacing (um)
+STEP_Y = 320.0
 
+_OFFSET_KEYS = ['offset_right_x', 'offset_right_y', 'offset_left_x', 'offset_left_y',
+                'first_right_x_offset', 'first_right_y_offset', 'first_down_x_offset', 'first_down_y_offset',
+                'subseq_down_x_offset', 'subseq_down_y_offset', 'diag_right_down_x', 'diag_right_down_y',
+                'sweep_right_down_x', 'sweep_right_down_y', 'sweep_left_down_x', 'sweep_left_down_y']
 
-def create_movement_state():
-    """Create initial movement state"""
-    return {
-        'prev_x': None,
-        'prev_y': None,
-        'prev_dir_x': None,
-        'prev_dir_y': None,
-        'first_down_done': False,
-        'tiles_processed': 0,
-    }
+
+def identity_matrix(microscope_id='default'):
+    """Enabled correction matrix that changes nothing (no scale, skew or offsets)"""
+    cm = mc.create_default_correction_matrix(microscope_id)
+    cm['enabled'] = True
+    cm['pixel_size_um'] = PX_UM
+    cm['scale_x'] = cm['scale_y'] = 1.0
+    cm['skew_xy'] = cm['skew_yx'] = 0.0
+    for key in _OFFSET_KEYS:
+        cm[key] = 0.0
+    return cm
 
 
-def calculate_thermal_load_factor(z_stack_height_um, num_channels, num_tiles):
-    """Calculate thermal load factor based on acquisition parameters"""
-    z_factor = z_stack_height_um / 100.0
-    ch_factor = num_channels / 3.0
-    tile_factor = num_tiles / 50.0
-    thermal_load = 0.4 * z_factor + 0.3 * ch_factor + 0.3 * tile_factor
-    return thermal_load
-
-
-def select_thermal_drift(correction_matrix, thermal_load_factor):
-    """Select appropriate thermal drift correction based on system state"""
-    thermal_state = correction_matrix['thermal_state']
-    
-    if thermal_state == 'cold':
-        drift_x = correction_matrix['thermal_drift_x_cold'] * thermal_load_factor
-        drift_y = correction_matrix['thermal_drift_y_cold'] * thermal_load_factor
-    elif thermal_state == 'preheated':
-        drift_x = correction_matrix['thermal_drift_x_preheated'] * thermal_load_factor
-        drift_y = correction_matrix['thermal_drift_y_preheated'] * thermal_load_factor
-    else:
-        drift_x = correction_matrix['thermal_drift_x_cold'] * thermal_load_factor
-        drift_y = correction_matrix['thermal_drift_y_cold'] * thermal_load_factor
-    
-    return drift_x, drift_y
-
-
-def classify_movement(tile_x_um, tile_y_um, movement_state, tile_width_um, tile_height_um, correction_matrix):
-    """
-    Classify movement type for current tile.
-    
-    Returns: (state_code, state_name, is_long_move)
-    """
-    # First tile
-    if movement_state['prev_x'] is None:
-        return 'START', 'start', False
-    
-    # Calculate movement
-    delta_x = tile_x_um - movement_state['prev_x']
-    delta_y = tile_y_um - movement_state['prev_y']
-    
-    # Classify direction
-    curr_dir_x = None
-    if abs(delta_x) > 0.5:
-        curr_dir_x = 'right' if delta_x > 0 else 'left'
-    
-    curr_dir_y = None
-    if abs(delta_y) > 0.5:
-        curr_dir_y = 'down' if delta_y > 0 else None  # Up not primary
-    
-    # Check for long moves
-    long_threshold_x = correction_matrix['long_move_threshold_x']
-    is_long_x = abs(delta_x) > long_threshold_x * tile_width_um
-    
-    # Determine state
-    if is_long_x and curr_dir_x == 'right':
-        return 'LONG_R', 'long_right', True
-    elif is_long_x and curr_dir_x == 'left':
-        return 'LONG_L', 'long_left', True
-    elif curr_dir_y == 'down' and not movement_state['first_down_done']:
-        return 'FIRST_DOWN', 'down', False
-    elif curr_dir_y == 'down':
-        return 'TO_DOWN', 'down', False
-    elif movement_state['prev_dir_x'] == 'right' and curr_dir_x == 'left':
-        return 'R_TO_L', 'left', False
-    elif movement_state['prev_dir_x'] == 'left' and curr_dir_x == 'right':
-        return 'L_TO_R', 'right', False
-    elif curr_dir_x == 'right':
-        return 'RIGHT', 'right', False
-    elif curr_dir_x == 'left':
-        return 'LEFT', 'left', False
-    elif curr_dir_y == 'down':
-        return 'DOWN', 'down', False
-    else:
-        return 'UNKNOWN', 'unknown', False
-
-
-def apply_corrections_to_tile(tile_x_um, tile_y_um, tile_index, tile_width_um, tile_height_um,
-                               correction_matrix, movement_state):
-    """
-    Apply systematic error corrections to tile position.
-    
-    Returns: (corrected_x_um, corrected_y_um, state_name)
-    """
-    
-    # Classify movement
-    state_code, state_name, is_long_move = classify_movement(
-        tile_x_um, tile_y_um, movement_state, tile_width_um, tile_height_um, correction_matrix
-    )
-    
-    # Initialize offsets
-    offset_x = 0.0
-    offset_y = 0.0
-    
-    # Calculate thermal drift
-    tiles_processed = movement_state['tiles_processed']
-    decay_factor = correction_matrix['thermal_decay_rate'] ** tiles_processed
-    thermal_load = correction_matrix['thermal_factors']['thermal_load_factor']
-    thermal_x, thermal_y = select_thermal_drift(correction_matrix, thermal_load)
-    offset_x += thermal_x * decay_factor
-    offset_y += thermal_y * decay_factor
-    
-    # Apply backlash corrections based on state
-    if state_code == 'R_TO_L':
-        offset_x += correction_matrix['backlash_x_left']
-    elif state_code == 'L_TO_R':
-        offset_x += correction_matrix['backlash_x_right']
-    elif state_code == 'FIRST_DOWN':
-        offset_y += correction_matrix['first_down_y_offset']
-        movement_state['first_down_done'] = True
-    elif state_code == 'TO_DOWN':
-        offset_y += correction_matrix['backlash_y_down']
-    elif state_code == 'LONG_R':
-        offset_x += correction_matrix['backlash_long_x_right']
-    elif state_code == 'LONG_L':
-        offset_x += correction_matrix['backlash_long_x_left']
-    
-    # Apply scale and skew corrections
-    x_corrected, y_corrected = MatrixOps.apply_2d_transform(
-        tile_x_um, tile_y_um,
-        correction_matrix['scale_x'],
-        correction_matrix['scale_y'],
-        correction_matrix['skew_xy'],
-        correction_matrix['skew_yx'],
-        offset_x,
-        offset_y
-    )
-    
-    # Update state for next tile
-    if movement_state['prev_x'] is not None:
-        delta_x = tile_x_um - movement_state['prev_x']
-        delta_y = tile_y_um - movement_state['prev_y']
-        
-        if abs(delta_x) > 0.5:
-            movement_state['prev_dir_x'] = 'right' if delta_x > 0 else 'left'
-        if abs(delta_y) > 0.5:
-            movement_state['prev_dir_y'] = 'down' if delta_y > 0 else None
-    
-    movement_state['prev_x'] = tile_x_um
-    movement_state['prev_y'] = tile_y_um
-    movement_state['tiles_processed'] += 1
-    
-    return x_corrected, y_corrected, state_name
-
-
-def visualize_grid(tiles, grid_width, grid_height):
-    """
-    Generate ASCII visualization of tile grid.
-    
-    Args:
-        tiles: List of (x, y) positions in grid coordinates
-        grid_width: Width of bounding box
-        grid_height: Height of bounding box
-    
-    Returns: List of strings representing grid rows
-    """
-    # Create empty grid
-    grid = [['.' for _ in range(grid_width)] for _ in range(grid_height)]
-    
-    # Place tiles
+def correct_all(tiles, cm):
+    """Per-tile corrections of a tile sequence -> list of (dx_um, dy_um, state)"""
+    state = mc.create_movement_state()
+    out = []
     for i, (x, y) in enumerate(tiles):
-        gx = int(round(x))
-        gy = int(round(y))
-        if 0 <= gx < grid_width and 0 <= gy < grid_height:
-            if i == 0:
-                grid[gy][gx] = '0'
-            else:
-                grid[gy][gx] = 'x'
-    
-    # Convert to strings
-    return [''.join(row) for row in grid]
+        xc, yc, name = mc.apply_metadata_corrections(x, y, i, STEP_X, STEP_Y, cm, state)
+        out.append((xc - x, yc - y, name))
+    return out
 
 
 # ============================================================================
@@ -264,83 +60,50 @@ def test_basic_correction_application():
     print("TEST 1: Basic Correction Application (No Errors)")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
-    movement_state = create_movement_state()
+    # Serpentine 2x2 grid
+    tiles = [(0.0, 0.0), (STEP_X, 0.0), (STEP_X, STEP_Y), (0.0, STEP_Y)]
+    res = correct_all(tiles, identity_matrix())
+    for i, (dx, dy, state) in enumerate(res):
+        print("Tile %d: correction (%.2f, %.2f) [state: %s]" % (i, dx, dy, state))
     
-    # Simple 2x2 grid
-    tiles = [
-        (0.0, 0.0),      # Tile 0 - start
-        (1000.0, 0.0),   # Tile 1 - right
-        (0.0, 1000.0),   # Tile 2 - down (Y change takes priority)
-        (1000.0, 1000.0) # Tile 3 - right
-    ]
-    
-    tile_width = 1000.0
-    tile_height = 1000.0
-    
-    states = []
-    for i, (x, y) in enumerate(tiles):
-        x_corr, y_corr, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
-        states.append(state)
-        print("Tile %d: (%.1f, %.1f) -> (%.1f, %.1f) [state: %s]" % (i, x, y, x_corr, y_corr, state))
-    
-    print("\nState sequence: %s" % ', '.join(states))
-    
-    # Verify states - note that tile 2 is 'down' because Y movement is detected
-    expected_states = ['start', 'right', 'down', 'right']
+    states = [r[2] for r in res]
+    expected_states = ['start', 'first_right', 'first_down', 'left']
     assert states == expected_states, "Expected %s, got %s" % (expected_states, states)
+    assert all(abs(dx) < 1e-9 and abs(dy) < 1e-9 for dx, dy, _ in res), "Identity matrix must not move tiles"
     print("✓ State sequence correct")
     
     return True
 
 
 def test_backlash_correction():
-    """Test backlash correction on direction changes"""
+    """Test state-dependent offsets on direction changes"""
     print("\n" + "="*70)
     print("TEST 2: Backlash Correction")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
-    correction_matrix['backlash_x_left'] = 5.0   # 5μm backlash right->left
-    correction_matrix['backlash_x_right'] = 3.0  # 3μm backlash left->right
-    correction_matrix['backlash_y_down'] = 4.0   # 4μm backlash down
-    
-    movement_state = create_movement_state()
+    cm = identity_matrix()
+    cm['offset_right_x'] = 3.0   # px, steady right
+    cm['offset_left_x'] = -5.0   # px, left
+    cm['subseq_down_y_offset'] = 4.0  # px, down after the first one
     
-    # Test pattern with direction changes
     tiles = [
-        (0.0, 0.0),      # start
-        (1000.0, 0.0),   # right
-        (2000.0, 0.0),   # right
-        (1000.0, 0.0),   # left (backlash_x_left should apply)
-        (0.0, 0.0),      # left
-        (1000.0, 0.0),   # right (backlash_x_right should apply)
-        (1000.0, 1000.0) # down (backlash_y_down should apply)
+        (0.0, 0.0),                 # start
+        (STEP_X, 0.0),              # first right (own offsets, zero here)
+        (2 * STEP_X, 0.0),          # right
+        (STEP_X, 0.0),              # left
+        (STEP_X, STEP_Y),           # first down
+        (STEP_X, 2 * STEP_Y)        # subsequent down
     ]
+    res = correct_all(tiles, cm)
+    for i, (dx, dy, state) in enumerate(res):
+        print("Tile %d: state=%s, correction=(%.2f, %.2f) um" % (i, state, dx, dy))
     
-    tile_width = 1000.0
-    tile_height = 1000.0
-    
-    corrections = []
-    for i, (x, y) in enumerate(tiles):
-        x_corr, y_corr, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
-        delta_x = x_corr - x
-        delta_y = y_corr - y
-        corrections.append((delta_x, delta_y, state))
-        print("Tile %d: state=%s, correction=(%.1f, %.1f)" % (i, state, delta_x, delta_y))
-    
-    # Check backlash was applied
-    # Tile 3 should have backlash_x_left
-    assert abs(corrections[3][0] - 5.0) < 0.1, "Expected 5.0μm backlash, got %.1f" % corrections[3][0]
-    print("✓ Right->Left backlash applied correctly")
-    
-    # Tile 5 should have backlash_x_right
-    assert abs(corrections[5][0] - 3.0) < 0.1, "Expected 3.0μm backlash, got %.1f" % corrections[5][0]
-    print("✓ Left->Right backlash applied correctly")
+    assert res[2][2] == 'right' and abs(res[2][0] - 3.0 * PX_UM) < 1e-9
+    print("✓ Right offset applied correctly")
+    assert res[3][2] == 'left' and abs(res[3][0] + 5.0 * PX_UM) < 1e-9
+    print("✓ Right->Left offset applied correctly")
+    assert res[5][2] == 'down_left' and abs(res[5][1] - 4.0 * PX_UM) < 1e-9
+    print("✓ Subsequent down offset applied correctly")
     
     return True
 
@@ -351,7 +114,6 @@ def test_thermal_load_calculation():
     print("TEST 3: Thermal Load Calculation")
     print("="*70)
     
-    # Test different scenarios
     test_cases = [
         (50.0, 3, 50, "Baseline (50μm, 3ch, 50 tiles)"),
         (100.0, 3, 50, "2x Z-stack"),
@@ -360,10 +122,14 @@ def test_thermal_load_calculation():
         (200.0, 6, 100, "High load (2x Z, 2x Ch, 2x Tiles)")
     ]
     
+    factors = []
     for z, ch, tiles_count, desc in test_cases:
-        factor = calculate_thermal_load_factor(z, ch, tiles_count)
+        factor = mc.calculate_thermal_load_factor(z, ch, tiles_count)
+        factors.append(factor)
         print("%s: %.3f" % (desc, factor))
     
+    assert abs(factors[0] - 0.8) < 1e-9, "Baseline: 0.4*0.5 + 0.3*1 + 0.3*1"
+    assert all(f > factors[0] for f in factors[1:]), "More load must raise the factor"
     print("✓ Thermal load calculations complete")
     return True
 
@@ -374,78 +140,56 @@ def test_first_down_special_case():
     print("TEST 4: First Down Special Case")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
-    correction_matrix['first_down_y_offset'] = 10.0  # Special first down offset
-    correction_matrix['backlash_y_down'] = 5.0       # Normal down backlash
+    cm = identity_matrix()
+    cm['first_down_y_offset'] = 10.0   # px, stiction break on the first down
+    cm['subseq_down_y_offset'] = 5.0   # px, every later down
     
-    movement_state = create_movement_state()
-    
-    # Grid with two down movements
     tiles = [
-        (0.0, 0.0),      # start
-        (1000.0, 0.0),   # right
-        (1000.0, 1000.0), # down (FIRST - should use first_down_y_offset)
-        (0.0, 1000.0),   # left
-        (0.0, 2000.0)    # down (subsequent - should use backlash_y_down)
+        (0.0, 0.0),             # start
+        (STEP_X, 0.0),          # right
+        (STEP_X, STEP_Y),       # down (FIRST - should use first_down_y_offset)
+        (0.0, STEP_Y),          # left
+        (0.0, 2 * STEP_Y)       # down (subsequent - should use subseq_down_y_offset)
     ]
+    res = correct_all(tiles, cm)
+    for i, (dx, dy, state) in enumerate(res):
+        print("Tile %d: state=%s, y_correction=%.2f um" % (i, state, dy))
     
-    tile_width = 1000.0
-    tile_height = 1000.0
-    
-    for i, (x, y) in enumerate(tiles):
-        x_corr, y_corr, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
-        delta_y = y_corr - y
-        print("Tile %d: state=%s, y_correction=%.1f" % (i, state, delta_y))
-        
-        if i == 2:
-            # First down should use first_down_y_offset
-            assert abs(delta_y - 10.0) < 0.1, "Expected 10.0μm first down, got %.1f" % delta_y
-            print("  ✓ First down offset applied")
+    assert res[2][2] == 'first_down' and abs(res[2][1] - 10.0 * PX_UM) < 1e-9
+    print("  ✓ First down offset applied")
+    assert res[4][2] == 'down_left' and abs(res[4][1] - 5.0 * PX_UM) < 1e-9
+    print("  ✓ Subsequent down offset applied")
     
     print("✓ First down special case handled correctly")
     return True
 
 
-def test_long_move_detection():
-    """Test long move detection and different backlash"""
+def test_sweep_detection():
+    """Test sweep (long move) detection and its own offsets"""
     print("\n" + "="*70)
-    print("TEST 5: Long Move Detection")
+    print("TEST 5: Sweep Detection")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
-    correction_matrix['backlash_x_left'] = 5.0
-    correction_matrix['backlash_long_x_left'] = 2.0  # Reduced backlash for long moves
-    correction_matrix['long_move_threshold_x'] = 2.0
+    cm = identity_matrix()
+    cm['offset_left_x'] = -5.0
+    cm['sweep_left_down_x'] = 36.0
     
-    movement_state = create_movement_state()
+    # Row traced right, then a flyback to the row start one row down (> sweep_limit px)
+    tiles = [(0.0, 0.0), (STEP_X, 0.0), (2 * STEP_X, 0.0), (3 * STEP_X, 0.0), (0.0, STEP_Y)]
+    res = correct_all(tiles, cm)
+    for i, (dx, dy, state) in enumerate(res):
+        print("Tile %d: pos=(%.1f, %.1f), state=%s, x_correction=%.2f um" % (
+            i, tiles[i][0], tiles[i][1], state, dx))
     
-    tile_width = 1000.0
-    tile_height = 1000.0
+    assert 3 * STEP_X / PX_UM > cm['sweep_limit']
+    assert res[4][2] == 'sweep_left_down', "Expected 'sweep_left_down' state, got %s" % res[4][2]
+    assert abs(res[4][0] - 36.0 * PX_UM) < 1e-9, "Sweep offset instead of the left offset"
+    print("  ✓ Sweep detected and sweep offset applied")
     
-    # Pattern: short right, short right, LONG left (circle tracing)
-    tiles = [
-        (0.0, 0.0),
-        (1000.0, 0.0),    # short right
-        (2000.0, 0.0),    # short right
-        (-1000.0, 0.0)    # LONG left (3x tile width)
-    ]
+    short = correct_all([(0.0, 0.0), (STEP_X, 0.0), (0.0, 0.0)], cm)
+    assert short[2][2] == 'left', "One tile back is a normal move"
     
-    for i, (x, y) in enumerate(tiles):
-        x_corr, y_corr, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
-        delta_x = x_corr - x
-        print("Tile %d: pos=(%.1f, %.1f), state=%s, x_correction=%.1f" % (i, x, y, state, delta_x))
-        
-        if i == 3:
-            # Long left should use backlash_long_x_left
-            assert abs(delta_x - 2.0) < 0.1, "Expected 2.0μm long backlash, got %.1f" % delta_x
-            assert state == 'long_left', "Expected 'long_left' state, got %s" % state
-            print("  ✓ Long move detected and long backlash applied")
-    
-    print("✓ Long move handling correct")
+    print("✓ Sweep handling correct")
     return True
 
 
@@ -455,7 +199,7 @@ def test_grid_visualization():
     print("TEST 6: Grid Visualization")
     print("="*70)
     
-    # Create 10-tile grid matching example in design doc
+    # 10-tile grid matching example in design doc
     tiles_grid = [
         (0, 0),  # 0
         (1, 0),  # 1
@@ -464,31 +208,20 @@ def test_grid_visualization():
         (2, 3), (3, 3)   # Row 4 partial
     ]
     
-    grid_vis = visualize_grid(tiles_grid, 4, 5)
+    grid_vis = mc.visualize_grid_layout([{'x_grid': x, 'y_grid': y} for x, y in tiles_grid], 4, 5)
     
     print("\n=== GRID LAYOUT ===")
     for row in grid_vis:
         print(row)
+    assert grid_vis == ['0x..', 'xxxx', '..xx', '..xx', '....'], "Got %r" % grid_vis
     
-    # Process for state sequence
-    correction_matrix = create_default_correction_matrix()
-    correction_matrix['long_move_threshold_x'] = 2.0
-    movement_state = create_movement_state()
-    
-    # Convert grid coords to micrometers
-    tile_width = 1000.0
-    tile_height = 1000.0
-    tiles_um = [(x * tile_width, y * tile_height) for x, y in tiles_grid]
-    
-    states = []
-    for i, (x, y) in enumerate(tiles_um):
-        _, _, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
-        states.append(state)
+    # State sequence of the same layout
+    tiles_um = [(x * STEP_X, y * STEP_Y) for x, y in tiles_grid]
+    states = [r[2] for r in correct_all(tiles_um, identity_matrix())]
     
     print("\n=== STATE SEQUENCE ===")
     print(", ".join(states))
+    assert len(states) == len(tiles_grid) and states[0] == 'start'
     
     print("✓ Grid visualization generated")
     return True
@@ -500,18 +233,12 @@ def test_scale_and_skew():
     print("TEST 7: Scale and Skew Corrections")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
-    correction_matrix['scale_x'] = 1.01  # 1% X scale error
-    correction_matrix['scale_y'] = 0.99  # 1% Y scale error
-    correction_matrix['skew_xy'] = 0.001 # X->Y coupling
-    correction_matrix['skew_yx'] = 0.002 # Y->X coupling
+    cm = identity_matrix()
+    cm['scale_x'] = 1.01  # 1% X scale error
+    cm['scale_y'] = 0.99  # 1% Y scale error
+    cm['skew_xy'] = 0.001 # X->Y coupling
+    cm['skew_yx'] = 0.002 # Y->X coupling
     
-    movement_state = create_movement_state()
-    
-    tile_width = 1000.0
-    tile_height = 1000.0
-    
-    # Test at different positions
     test_positions = [
         (0.0, 0.0),
         (10000.0, 0.0),
@@ -519,19 +246,15 @@ def test_scale_and_skew():
         (10000.0, 10000.0)
     ]
     
-    for i, (x, y) in enumerate(test_positions):
-        x_corr, y_corr, state = apply_corrections_to_tile(
-            x, y, i, tile_width, tile_height, correction_matrix, movement_state
-        )
+    for i, (dx, dy, state) in enumerate(correct_all(test_positions, cm)):
+        x, y = test_positions[i]
+        x_corr, y_corr = x + dx, y + dy
         print("Pos (%.0f, %.0f) -> (%.1f, %.1f)" % (x, y, x_corr, y_corr))
-        
-        # At far corner, effects should be visible
-        if i == 3:
-            expected_x = 10000.0 * 1.01 + 10000.0 * 0.001  # scale + skew
-            expected_y = 10000.0 * 0.002 + 10000.0 * 0.99  # skew + scale
-            assert abs(x_corr - expected_x) < 1.0, "X correction mismatch"
-            assert abs(y_corr - expected_y) < 1.0, "Y correction mismatch"
-            print("  ✓ Scale and skew applied correctly at far corner")
+        expected_x = 1.01 * x + 0.001 * y  # scale + skew
+        expected_y = 0.002 * x + 0.99 * y  # skew + scale
+        assert abs(x_corr - expected_x) < 1e-6, "X correction mismatch"
+        assert abs(y_corr - expected_y) < 1e-6, "Y correction mismatch"
+    print("  ✓ Scale and skew applied correctly at every corner")
     
     print("✓ Scale and skew corrections validated")
     return True
@@ -543,20 +266,22 @@ def test_microscope_selection():
     print("TEST 8: Multiple Microscope Support")
     print("="*70)
     
-    # Create configurations for different microscopes
     microscopes = {
-        'zeiss_axio_1': create_default_correction_matrix('zeiss_axio_1'),
-        'zeiss_axio_2': create_default_correction_matrix('zeiss_axio_2'),
-        'default': create_default_correction_matrix('default')
+        'zeiss_axio_1': mc.create_default_correction_matrix('zeiss_axio_1'),
+        'zeiss_axio_2': mc.create_default_correction_matrix('zeiss_axio_2'),
+        'default': mc.create_default_correction_matrix('default')
     }
     
-    # Set different backlash for each microscope
-    microscopes['zeiss_axio_1']['backlash_x_left'] = 5.0
-    microscopes['zeiss_axio_2']['backlash_x_left'] = 8.0
-    microscopes['default']['backlash_x_left'] = 3.0
+    # Different offsets per microscope must not leak into the others
+    microscopes['zeiss_axio_1']['offset_left_x'] = 5.0
+    microscopes['zeiss_axio_2']['offset_left_x'] = 8.0
+    microscopes['default']['offset_left_x'] = 3.0
     
     for name, matrix in microscopes.items():
-        print("Microscope '%s': X-left backlash = %.1fμm" % (name, matrix['backlash_x_left']))
+        print("Microscope '%s': left X-offset = %.1f px" % (name, matrix['offset_left_x']))
+        assert matrix['microscope_id'] == name
+        assert not matrix['enabled'], "Corrections are opt-in"
+    assert mc.create_default_correction_matrix('zeiss_axio_1')['offset_left_x'] != 5.0
     
     print("✓ Multiple microscope configurations supported")
     return True
@@ -568,7 +293,7 @@ def test_thermal_state_selection():
     print("TEST 9: Thermal State (Cold vs Preheated)")
     print("="*70)
     
-    correction_matrix = create_default_correction_matrix()
+    correction_matrix = mc.create_default_correction_matrix()
     correction_matrix['thermal_drift_x_cold'] = 10.0
     correction_matrix['thermal_drift_y_cold'] = 8.0
     correction_matrix['thermal_drift_x_preheated'] = 2.0
@@ -578,19 +303,19 @@ def test_thermal_state_selection():
     
     # Test cold state
     correction_matrix['thermal_state'] = 'cold'
-    drift_x, drift_y = select_thermal_drift(correction_matrix, thermal_load)
+    drift_x, drift_y = mc.select_thermal_drift(correction_matrix, thermal_load)
     print("Cold state drift: (%.1f, %.1f) μm" % (drift_x, drift_y))
     assert drift_x == 10.0 and drift_y == 8.0
     
     # Test preheated state
     correction_matrix['thermal_state'] = 'preheated'
-    drift_x, drift_y = select_thermal_drift(correction_matrix, thermal_load)
+    drift_x, drift_y = mc.select_thermal_drift(correction_matrix, thermal_load)
     print("Preheated state drift: (%.1f, %.1f) μm" % (drift_x, drift_y))
     assert drift_x == 2.0 and drift_y == 1.5
     
     # Test unknown state (should default to cold)
     correction_matrix['thermal_state'] = 'unknown'
-    drift_x, drift_y = select_thermal_drift(correction_matrix, thermal_load)
+    drift_x, drift_y = mc.select_thermal_drift(correction_matrix, thermal_load)
     print("Unknown state drift (defaults to cold): (%.1f, %.1f) μm" % (drift_x, drift_y))
     assert drift_x == 10.0 and drift_y == 8.0
     
@@ -598,6 +323,63 @@ def test_thermal_state_selection():
     return True
 
 
+def test_batch_correction_matches_per_tile():
+    """Test batch API of the real module against per-tile corrections"""
+    print("\n" + "="*70)
+    print("TEST 10: Batch Correction (main/metadata_correction.py)")
+    print("="*70)
+    
+    cm = mc.create_default_correction_matrix()
+    cm['enabled'] = True
+    cm['thermal_state'] = 'cold'
+    cm['thermal_drift_x_cold'] = 1.5
+    cm['thermal_drift_y_cold'] = -0.5
+    cm['thermal_factors']['thermal_load_factor'] = 0.7
+    
+    # Serpentine 8x4 grid, then a sweep right+down and a sweep back left+down
+    xs, ys = [], []
+    for row in range(4):
+        cols = range(8) if row % 2 == 0 else range(7, -1, -1)
+        for col in cols:
+            xs.append(col * 377.0 + (row * 0.3))
+            ys.append(row * 320.0)
+    xs += [10000.0, 0.0]
+    ys += [5000.0, 5400.0]
+    
+    state = mc.create_movement_state()
+    expected = [mc.apply_metadata_corrections(x, y, i, 1.0, 1.0, cm, state) for i, (x, y) in enumerate(zip(xs, ys))]
+    
+    numpy_module = mc.np
+    try:
+        results = [mc.correct_positions(xs, ys, cm)]
+        mc.np = None  # Pure-Python path (as under Jython)
+        results.append(mc.correct_positions(xs, ys, cm))
+    finally:
+        mc.np = numpy_module
+    
+    for res in results:
+        for i, (x, y, name) in enumerate(expected):
+            assert abs(res['x'][i] - x) < 1e-9 and abs(res['y'][i] - y) < 1e-9, "Tile %d position mismatch" % i
+            assert res['states'][i] == name, "Tile %d: %s != %s" % (i, res['states'][i], name)
+    assert results[0]['masks'] == results[1]['masks']
+    
+    stats = results[0]['stats']
+    assert sum(st['count'] for st in stats.values()) == len(xs)
+    assert stats[mc.MASK_START]['count'] == 1 and stats[10]['count'] == 1 and stats[9]['count'] == 1
+    assert stats[7]['state'] == 'sweep_right_down' and stats[5]['state'] == 'sweep_left_down'
+    for m in sorted(stats):
+        st = stats[m]
+        print("  mask %2d %-16s %3d tiles, mean shift (%.2f, %.2f) um" % (m, st['state'], st['count'],
+                                                                        st['mean_x'], st['mean_y']))
+    
+    cm['enabled'] = False
+    passthrough = mc.correct_positions(xs, ys, cm)
+    assert passthrough['x'] == xs and passthrough['states'][0] == 'passthrough'
+    
+    print("✓ Batch corrections match per-tile corrections (NumPy and pure Python)")
+    return True
+
+
 # ============================================================================
 # MAIN TEST RUNNER
 # ============================================================================
@@ -613,11 +395,12 @@ def run_all_tests():
         test_backlash_correction,
         test_thermal_load_calculation,
         test_first_down_special_case,
-        test_long_move_detection,
+        test_sweep_detection,
         test_grid_visualization,
         test_scale_and_skew,
         test_microscope_selection,
-        test_thermal_state_selection
+        test_thermal_state_selection,
+        test_batch_correction_matches_per_tile
     ]
     
     passed = 0
@@ -0,0 +1,709 @@
+"""
+Test suite for the Java-free stitcher core (main/stitcher_core.py).
+
+Exercises metadata parsing against the SAMPLES/ dataset, TileConfiguration
+round-trips and the neighbor-constrained fallback without Fiji.
+
+Run with: python test_stitcher_core.py (CPython)
+         or jython test_stitcher_core.py (Jython/Fiji)
+
+Note: Jython-compatible - no encoding declaration or shebang.
+"""
+
+import sys
+import os
+import json
+import codecs
+import shutil
+import struct
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "main"))
+
+import stitcher_core as core
+
+SAMPLES = os.path.join(ROOT, "SAMPLES")
+
+
+def _read_sample(name):
+    with codecs.open(os.path.join(SAMPLES, name), 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _tile(name, index, xy, predicted=None, correlation=1.0, failed=False):
+    return name, {
+        'xy': xy,
+        'correlation': correlation,
+        'failed': failed,
+        'index': index,
+        'predicted_xy': predicted,
+        'movement_state': None,
+        'grid_pos': (0, 0)
+    }
+
+
+# ============================================================================
+# METADATA PARSING
+# ============================================================================
+
+def test_stage_labels_from_sample_xml():
+    """All scene positions are parsed with their stage coordinates"""
+    print("\n" + "="*70)
+    print("TEST: Stage labels from SAMPLES/OME.xml")
+    print("="*70)
+
+    labels = core._parse_stagelabels_from_xml(_read_sample("OME.xml"))
+    assert len(labels) == 9, "Expected 9 stage labels, got %d" % len(labels)
+    assert labels[0]['name'] == 'Scene position #0'
+    assert abs(labels[0]['x'] - 44573.391) < 1e-6
+    assert abs(labels[0]['y'] - 46307.761) < 1e-6
+
+    print("[OK] %d stage labels parsed" % len(labels))
+    return True
+
+
+def test_stage_label_lookup_reuses_parsed_labels():
+    """Passing pre-parsed labels gives the same answer as parsing again"""
+    xml = _read_sample("OME.xml")
+    labels = core._parse_stagelabels_from_xml(xml)
+    for s in range(len(labels)):
+        assert core.try_ome_stage_labels_from_xml(xml, None, s, labels=labels) == \
+            core.try_ome_stage_labels_from_xml(xml, None, s)
+    print("[OK] cached and uncached lookups agree")
+    return True
+
+
+def test_pixel_size_and_channel_colors():
+    """PhysicalSizeX and channel colors come from the first Pixels/Channel tags"""
+    xml = _read_sample("OME.xml")
+    px, unit = core._parse_pixels_physicalsize_from_xml(xml)
+    assert abs(px - 0.345) < 1e-9, "Expected 0.345, got %r" % px
+    assert core._unit_to_um(px, unit) == px
+
+    colors = core.parse_channel_colors_from_ome_xml(xml)
+    assert colors == [7798783, 16724991, -16771841], "Got %r" % colors
+    print("[OK] pixel size %.3f um, %d channel colors" % (px, len(colors)))
+    return True
+
+
+def test_pixel_from_global_metadata():
+    """Camera pixel distances are picked as (min, median) from the global map"""
+    with open(os.path.join(SAMPLES, "global_metadata.json")) as f:
+        gmeta = json.load(f)
+    mn, med = core._pixel_from_global_metadata(gmeta)
+    assert abs(mn - 2.2) < 1e-9, "Expected min 2.2, got %r" % mn
+    assert abs(med - 3.45) < 1e-9, "Expected median 3.45, got %r" % med
+    assert core._pixel_from_global_metadata({}) == (None, None)
+    print("[OK] global metadata pixel candidates: %.2f / %.2f" % (mn, med))
+    return True
+
+
+def test_unit_conversion():
+    """Length units are converted to micrometers"""
+    assert abs(core._unit_to_um(1.0, 'nm') - 0.001) < 1e-12
+    assert core._unit_to_um(2.0, 'mm') == 2000.0
+    assert core._unit_to_um(3.0, u'\u00b5m') == 3.0
+    assert core._unit_to_um(3.0, u'\u03bcm') == 3.0
+    assert core._hex_to_rgb('#FF8000') == (255, 128, 0)
+    print("[OK] unit conversions")
+    return True
+
+
+# ============================================================================
+# TILE CONFIGURATION
+# ============================================================================
+
+def test_tile_configuration_roundtrip():
+    """Written 2D/3D layouts parse back to the same positions"""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "TileConfiguration.txt")
+        entries = [("S000.tif", 0.0, 0.0), ("S001.tif", 1100.25, -3.5), ("S002.tif", 0.0, 0.0)]
+        core.write_tile_configuration(path, entries, dim=2)
+        tiles = core.read_tile_configuration(path)
+        assert core.ordered_tile_names(tiles) == ["S000.tif", "S001.tif", "S002.tif"]
+        assert tiles["S001.tif"]['xy'] == (1100.25, -3.5)
+        assert not tiles["S000.tif"]['failed'], "Reference tile must not be flagged"
+        assert tiles["S002.tif"]['failed'], "Non-reference tile at (0,0) must be flagged"
+        assert core.tile_positions_from_placements(entries) == tiles, "Direct registration must match the file"
+
+        path3 = os.path.join(tmp, "TileConfiguration_3D.txt")
+        core.write_tile_configuration(path3, [("S000_3D.tif", 1.5, 2.5, 4.0)], dim=3)
+        with codecs.open(path3, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        assert lines == [u"dim = 3", u"S000_3D.tif; ; (1.500000, 2.500000, 4.000000)"], "Got %r" % lines
+    finally:
+        shutil.rmtree(tmp)
+    print("[OK] TileConfiguration round-trip")
+    return True
+
+
+# ============================================================================
+# NEIGHBOR-CONSTRAINED FALLBACK
+# ============================================================================
+
+def test_fallback_uses_neighbor_error():
+    """A failed tile gets its prediction plus the neighbors' registration error"""
+    tiles = dict([
+        _tile("S000.tif", 0, (0.0, 0.0), predicted=(0.0, 0.0)),
+        _tile("S001.tif", 1, (1010.0, 5.0), predicted=(1000.0, 0.0), correlation=0.9),
+        _tile("S002.tif", 2, (0.0, 0.0), predicted=(2000.0, 0.0), failed=True),
+    ])
+    failed, recovered = core.recover_failed_tiles(tiles, verbose=False)
+    assert failed == ["S002.tif"] and recovered == 1
+    x, y = tiles["S002.tif"]['xy']
+    # S000 (error 0, weight 1/1) and S001 (error (10,5), weight 0.9/1)
+    assert abs(x - (2000.0 + 9.0 / 1.9)) < 1e-9, "Got x=%r" % x
+    assert abs(y - (4.5 / 1.9)) < 1e-9, "Got y=%r" % y
+    return True
+
+
+def test_fallback_without_prediction_stays_failed():
+    """Without a metadata prediction the tile is left in place"""
+    tiles = dict([
+        _tile("S000.tif", 0, (0.0, 0.0)),
+        _tile("S001.tif", 1, (0.0, 0.0), failed=True),
+    ])
+    failed, recovered = core.recover_failed_tiles(tiles, verbose=False)
+    assert failed == ["S001.tif"] and recovered == 0
+    assert tiles["S001.tif"]['failed']
+    return True
+
+
+def test_attach_predictions():
+    """Predictions are stage offsets from the reference tile in pixels"""
+    tiles_db = dict([_tile("S000.tif", 0, (0.0, 0.0)), _tile("S001.tif", 1, (0.0, 0.0))])
+    stage = [{'i': 0, 'x_s': 100.0, 'y_s': 50.0}, {'i': 1, 'x_s': 134.5, 'y_s': 50.0}, {'i': 7, 'x_s': 0.0, 'y_s': 0.0}]
+    stored = core.attach_predictions(tiles_db, stage, {0: "S000.tif", 1: "S001.tif"}, 100.0, 50.0, 0.345)
+    assert stored == 2
+    assert abs(tiles_db["S001.tif"]['predicted_xy'][0] - 100.0) < 1e-9
+    return True
+
+
+# ============================================================================
+# SUBSET SELECTION
+# ============================================================================
+
+def test_subset_spec_parsing():
+    """ROI corners are normalized, z/c ranges are 1-based inclusive"""
+    spec = core.parse_subset_spec(u"roi=500,400,100,0; z=5-20\n# comment\nc=2")
+    assert spec['roi'] == (100.0, 0.0, 500.0, 400.0), "Got %r" % (spec['roi'],)
+    assert spec['z'] == (5, 20) and spec['c'] == (2, 2)
+    assert core.parse_subset_spec(u"  ") is None
+    for bad in (u"roi=1,2,3", u"z=5-2", u"z=0-3", u"t=1", u"roi"):
+        try:
+            core.parse_subset_spec(bad)
+            assert False, "Accepted %r" % bad
+        except ValueError:
+            pass
+    merged = core.merge_subset_specs(spec, core.parse_subset_spec(u"z=1-3"))
+    assert merged['z'] == (1, 3) and merged['roi'] == spec['roi']
+    return True
+
+
+def test_roi_tile_selection_and_plane_clamping():
+    """Tiles are kept when their centred footprint intersects the ROI"""
+    tiles = [{'i': i, 'x_s': 350.0 * i, 'y_s': 0.0} for i in range(5)]
+    sel = core.select_tiles_in_roi(tiles, (500.0, -10.0, 800.0, 10.0), 400.0, 300.0)
+    assert [t['i'] for t in sel] == [1, 2], "Got %r" % [t['i'] for t in sel]
+    assert len(core.select_tiles_in_roi(tiles, None, 400.0, 300.0)) == 5
+
+    assert core.clamp_plane_ranges({'roi': None, 'z': (5, 50), 'c': None}, 34, 3) == (4, 33, 0, 2)
+    assert core.clamp_plane_ranges({'roi': None, 'z': (1, 34), 'c': (1, 3)}, 34, 3) is None
+    return True
+
+
+def test_plane_ranges_outside_the_stack():
+    """Ranges past the stack are reported, ranges entirely outside rejected"""
+    for spec in ({'z': (50, 60), 'c': None}, {'z': None, 'c': (3, 4)}):
+        try:
+            core.clamp_plane_ranges(spec, 40, 2)
+            assert False, "Accepted %r" % spec
+        except ValueError:
+            pass
+    spec = {'z': (30, 60), 'c': (2, 4)}
+    planes = core.clamp_plane_ranges(spec, 40, 2)
+    assert planes == (29, 39, 1, 1), "Got %r" % (planes,)
+    assert core.clamped_plane_note(spec, planes) == u"z=30-60 reads 30-40, c=2-4 reads 2-2"
+    spec = {'z': (5, 10), 'c': None}
+    assert core.clamped_plane_note(spec, core.clamp_plane_ranges(spec, 40, 2)) is None
+    return True
+
+
+# ============================================================================
+# TIME-LAPSE
+# ============================================================================
+
+def test_timelapse_helpers():
+    """Reference frame is clamped, planes are streamed in XYCZT order"""
+    assert core.reference_timepoint(1, 10) == 0
+    assert core.reference_timepoint(25, 10) == 9
+    assert core.reference_timepoint(0, 10) == 0
+    order = [core.xyczt_plane_index(c, z, t, 2, 3) for t in range(2) for z in range(3) for c in range(2)]
+    assert order == list(range(12)), "Got %r" % order
+    return True
+
+
+# ============================================================================
+# OUTPUT BIT DEPTH
+# ============================================================================
+
+def test_display_range_from_streamed_histograms():
+    """Per-plane histograms add up and the range clips the saturated tails"""
+    total = [0] * 4096
+    plane = [0] * 4096
+    plane[100] = 5
+    plane[1000:1100] = [100] * 100
+    plane[4000] = 5
+    core.add_histogram(total, plane, 100, 4000)
+    core.add_histogram(total, plane, 100, 4000)
+    assert total[1050] == 200 and total[100] == 10
+    lo, hi = core.display_range(total)
+    assert (lo, hi) == (1000, 1099), "Outliers must be clipped, got %r" % ((lo, hi),)
+    assert core.display_range([0] * 16) == (0, 15)
+    offset, scale = core.inverse_depth_mapping(1000, 1255)
+    assert offset == 1000.0 and scale == 1.0
+    note = core.depth_mapping_note([(1000, 1099)])
+    assert "C1 = range 1000-1099" in note, note
+    return True
+
+
+# ============================================================================
+# SCENES
+# ============================================================================
+
+def test_scene_parsing_and_grouping():
+    """Tiles are split by the scene contour that contains them"""
+    with open(os.path.join(SAMPLES, "global_metadata.json")) as f:
+        gmeta = json.load(f)
+    scenes = core.parse_scenes_from_gmeta(gmeta)
+    assert len(scenes) == 1 and scenes[0]['name'] == 'TR1', "Got %r" % scenes
+    assert len(core.group_tiles_by_scene([{'x_s': 0.0, 'y_s': 0.0}], scenes)) == 1
+
+    multi = {}
+    for n, (name, cx) in enumerate([("Left", 1000.0), ("Right", 9000.0)]):
+        suffix = " #%d" % (n + 1)
+        multi["Information|Image|S|Scene|CenterPosition" + suffix] = "%.1f,500.0" % cx
+        multi["Information|Image|S|Scene|ContourSize" + suffix] = "2000,1000"
+        multi["Information|Image|S|Scene|Index" + suffix] = str(n)
+        multi["Information|Image|S|Scene|Name" + suffix] = name
+    scenes = core.parse_scenes_from_gmeta(multi)
+    assert [sc['name'] for sc in scenes] == ["Left", "Right"]
+
+    tiles = [{'i': i, 'x_s': x, 'y_s': 500.0} for i, x in enumerate([500.0, 8500.0, 1500.0, 9500.0, 6000.0])]
+    groups = core.group_tiles_by_scene(tiles, scenes)
+    assert [[t['i'] for t in ts] for _, ts in groups] == [[0, 2], [1, 3, 4]], "Got %r" % groups
+    assert core.safe_scene_name(u"Section 1/2") == u"Section_1_2"
+    return True
+
+
+# ============================================================================
+# MEMORY BUDGET
+# ============================================================================
+
+def test_tile_worker_budget():
+    """Small tiles run at full parallelism, huge tiles are throttled"""
+    gb = 1024 ** 3
+    small = core.estimate_tile_bytes(1216, 1028, 34, 3, 2)
+    big = core.estimate_tile_bytes(4096, 4096, 120, 4, 2, rolling_ball=True)
+    assert small < big
+    assert core.tile_worker_budget(small, 64 * gb, 4 * gb, 32)[0] == 32
+    workers, budget = core.tile_worker_budget(big, 64 * gb, 4 * gb, 32)
+    assert budget == 45 * gb
+    assert workers == budget // big and 1 <= workers < 32, "Got %d workers" % workers
+    assert core.tile_worker_budget(100 * gb, 8 * gb, 1 * gb, 8)[0] == 1
+    return True
+
+
+def test_files_to_stage():
+    """Read-ahead stays within free scratch minus the current file's reserve"""
+    gb = 1024 ** 3
+    assert core.files_to_stage([10 * gb, 10 * gb, 10 * gb], 100 * gb, 30 * gb) == 2
+    assert core.files_to_stage([10 * gb, 10 * gb], 45 * gb, 30 * gb) == 1
+    assert core.files_to_stage([80 * gb, 1 * gb], 100 * gb, 30 * gb) == 0, "Must not skip ahead"
+    assert core.files_to_stage([], 100 * gb, 0) == 0
+    return True
+
+
+def test_staged_subset_sidecar():
+    """A staged copy carries the subset sidecar under the name the loader looks for"""
+    tmp = tempfile.mkdtemp()
+    try:
+        src_dir, stage_dir = os.path.join(tmp, "src"), os.path.join(tmp, "stage")
+        os.makedirs(src_dir)
+        os.makedirs(stage_dir)
+        src = os.path.join(src_dir, "M.czi")
+        with open(src, 'wb') as f:
+            f.write(b'\x00' * 16)
+        with codecs.open(os.path.join(src_dir, "M.subset.txt"), 'w', encoding='utf-8') as f:
+            f.write(u"z=2-5")
+        dst = os.path.join(stage_dir, "M.czi")
+        shutil.copyfile(src, dst)
+        assert core.subset_sidecar_path(src) == os.path.join(src_dir, "M.subset.txt")
+        assert core.copy_subset_sidecar(src, dst)
+        assert core.load_subset_sidecar(dst) == core.load_subset_sidecar(src) is not None
+        assert not core.copy_subset_sidecar(dst + ".none.czi", dst), "No sidecar, nothing copied"
+    finally:
+        shutil.rmtree(tmp)
+    return True
+
+
+def test_stage_cache_roundtrip_and_lru():
+    """Entries restore their files and the oldest ones are evicted first"""
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, "input.czi")
+        with open(src, 'wb') as f:
+            f.write(b'\x01' * 5000)
+        ident = core.file_identity(src, sample_bytes=1024)
+        copy = os.path.join(tmp, "copy.czi")
+        shutil.copyfile(src, copy)
+        assert core.file_identity(copy, sample_bytes=1024) == ident, "Identity must not depend on the path"
+        assert core.cache_key(ident, 3, 50) == core.cache_key(ident, 3, 50)
+        assert core.cache_key(ident, 3, 50) != core.cache_key(ident, 3, 25)
+
+        cache = core.StageCache(os.path.join(tmp, "cache"), 12000)
+        keys = [core.cache_key(ident, i) for i in range(3)]
+        for i, k in enumerate(keys):
+            cache.store(k, {'series': i}, [src])
+            os.utime(os.path.join(cache.root, k, core.CACHE_META), (1000.0 + i, 1000.0 + i))
+        assert cache.lookup(keys[0]) == {'series': 0}, "Lookup marks entry 0 as most recent"
+        out = os.path.join(tmp, "out")
+        os.makedirs(out)
+        with open(cache.restore(keys[0], "input.czi", out), 'rb') as f:
+            assert f.read() == b'\x01' * 5000
+        removed, freed = cache.evict()
+        assert removed == 1 and freed > 5000, "Got %r" % ((removed, freed),)
+        assert cache.lookup(keys[1]) is None, "Least recently used entry must go"
+        assert cache.lookup(keys[0]) is not None and cache.lookup(keys[2]) is not None
+        assert cache.lookup("missing") is None
+    finally:
+        shutil.rmtree(tmp)
+    return True
+
+
+def test_settled_files():
+    """A file is ready once its size and mtime stop changing"""
+    state = {}
+    assert core.settled_files(state, {"a.czi": (100, 1.0)}, 0.0, 60) == []
+    assert core.settled_files(state, {"a.czi": (200, 2.0)}, 30.0, 60) == [], "Still growing"
+    assert core.settled_files(state, {"a.czi": (200, 2.0), "b.czi": (5, 1.0)}, 60.0, 60) == []
+    assert core.settled_files(state, {"a.czi": (200, 2.0), "b.czi": (5, 1.0)}, 90.0, 60) == ["a.czi"]
+    assert core.settled_files(state, {"b.czi": (5, 1.0)}, 120.0, 60) == ["b.czi"]
+    assert "a.czi" not in state, "Removed files are forgotten"
+    return True
+
+
+def test_job_spool_roundtrip():
+    """Jobs are claimed once, in submission order, and end in done/ or failed/"""
+    spool = tempfile.mkdtemp()
+    try:
+        a = core.submit_job(spool, ["a.czi"], {'rb_radius': 0, 'do_show': False, 'subset': 'z=2-5'})
+        b = core.submit_job(spool, ["b.czi", "c.czi"], output=spool)
+        assert core.read_job_status(spool, a)['state'] == 'queued'
+        job_id, job = core.claim_next_job(spool)
+        assert job_id == a and job['files'] == [os.path.abspath("a.czi")]
+        overrides = core.job_overrides(job['params'])
+        assert overrides['rb_radius'] == 0 and overrides['do_show'] is False
+        assert overrides['subset'] == core.parse_subset_spec('z=2-5')
+        assert core.claim_next_job(spool)[0] == b
+        assert core.claim_next_job(spool) is None, "Both jobs claimed"
+        core.write_job_status(spool, a, {'state': 'running', 'stage': 'fusion'})
+        assert core.read_job_status(spool, a)['stage'] == 'fusion'
+        core.finish_job(spool, a, 'done')
+        assert os.listdir(os.path.join(spool, 'done')) == [a + '.json']
+        assert core.job_overrides({'output_mode': core.OUTPUT_VIRTUAL})['output_mode'] == core.OUTPUT_VIRTUAL
+        for bad in ({'nope': 1}, {'rb_radius': 'x'}, {'do_save': 'yes'}, {'subset': 'q=1'},
+                    {'output_mode': 'virtaul'}, {'fusion_method': 'linear'}, {'output_depth': 8}):
+            try:
+                core.submit_job(spool, ["a.czi"], bad)
+                assert False, "Accepted %r" % bad
+            except ValueError:
+                pass
+    finally:
+        shutil.rmtree(spool)
+    return True
+
+
+def _hist(values, bins=256):
+    h = [0] * bins
+    for v in values:
+        h[v] += 1
+    return h
+
+
+def test_background_tiles():
+    """Glass tiles are found from MIP statistics and placed like their registered neighbours"""
+    glass = [10 + (k % 5) for k in range(1000)]
+    edge = glass[:990] + [200] * 10  # 1% tissue: still below the default 1%
+    tissue = glass[:600] + [120 + k % 80 for k in range(400)]
+    st = core.content_stats(_hist(tissue))
+    assert len(st['quantiles']) == 201 and st['quantiles'][0] == 10 and st['quantiles'][-1] == 199
+    assert st['entropy'] > core.content_stats(_hist(glass))['entropy']
+    assert abs(core.foreground_fraction(st, 100) - 0.4) < 0.01
+    stats = {'a': core.content_stats(_hist(tissue)), 'b': core.content_stats(_hist(glass)),
+             'c': core.content_stats(_hist(tissue)), 'd': core.content_stats(_hist(edge + [200] * 10))}
+    bg, threshold, fg = core.classify_background_tiles(stats)
+    assert bg == set(['b']), "Got %r (threshold %r, fg %r)" % (bg, threshold, fg)
+    bg, _, _ = core.classify_background_tiles(dict(a=stats['b'], b=stats['b'], c=stats['b']))
+    assert bg == set(), "No content at all: nothing to compare with"
+    bg, _, _ = core.classify_background_tiles(dict(a=stats['a'], b=stats['b'], c=stats['b']))
+    assert bg == set(), "At least two tiles must stay registered"
+
+    entries = [('a', 0.0, 0.0), ('b', 100.0, 0.0), ('c', 200.0, 0.0)]
+    tp = core.tile_positions_from_placements([('a', 3.0, 1.0), ('c', 205.0, 3.0)])
+    dx, dy = core.place_background_tiles(tp, entries, set(['b']))
+    assert (dx, dy) == (4.0, 2.0)
+    assert tp['b']['xy'] == (104.0, 2.0) and tp['b']['background']
+    assert core.ordered_tile_names(tp) == ['a', 'b', 'c']
+    return True
+
+
+def test_virtual_mosaic():
+    """BigDataViewer XML and manifest describe every tile/channel with its transform"""
+    import xml.etree.ElementTree as ET
+    tiles = [("M_mosaic/S000_3D.tif", 0.0, 0.0, 0.0), ("M_mosaic/S001_3D.tif", 900.5, 10.0, 2.0)]
+    m = core.mosaic_manifest(tiles, (1024, 1024, 20, 2), (0.5, 0.5, 2.0), [-16776961, 16711935], source="M")
+    assert [c['color'] for c in m['channels']] == ['#FF0000', '#00FF00']
+    tmp = tempfile.mkdtemp()
+    try:
+        xml_path = os.path.join(tmp, "M" + core.MOSAIC_XML_SUFFIX)
+        manifest_path = os.path.join(tmp, "M" + core.MOSAIC_MANIFEST_SUFFIX)
+        core.write_virtual_mosaic(xml_path, manifest_path, m)
+        root = ET.parse(xml_path).getroot()
+        maps = root.findall('.//FileMapping')
+        assert len(maps) == 4 and maps[3].get('channel') == '1'
+        assert maps[3].find('file').text == "M_mosaic/S001_3D.tif"
+        assert len(root.findall('.//ViewSetup')) == 4
+        reg = [r for r in root.findall('.//ViewRegistration') if r.get('setup') == '2'][0]
+        shift = [float(v) for v in reg.find('ViewTransform/affine').text.split()]
+        assert shift[3] == 900.5 and shift[7] == 10.0 and shift[11] == 8.0, "z offset in x-pixel units"
+        specs, back = core.read_mosaic_manifest(manifest_path)
+        assert specs[1] == (os.path.join(tmp, "M_mosaic", "S001_3D.tif"), 900.5, 10.0, 2.0)
+        assert back['voxel_um'] == [0.5, 0.5, 2.0]
+    finally:
+        shutil.rmtree(tmp)
+    xml = '<Image ID="Image:0"><Pixels PhysicalSizeX="0.3" PhysicalSizeZ="0.0015" PhysicalSizeZUnit="mm">'
+    assert abs(core.parse_z_step_from_xml(xml) - 1.5) < 1e-9
+    assert core.parse_z_step_from_xml('<Pixels PhysicalSizeX="1">') is None
+    return True
+
+
+def test_pipeline_tuning():
+    """The busiest stage grows while throughput improves and backs off otherwise"""
+    util = {'read': core.stage_utilisation(19.0, 2, 10.0), 'compute': core.stage_utilisation(20.0, 8, 10.0),
+            'write': core.stage_utilisation(1.0, 2, 10.0)}
+    assert core.bottleneck_stage(util) == 'read', "Got %r" % util
+    assert core.tune_pool_size(2, 0, 1.0, None, 1, 8) == (3, 1), "First call probes upwards"
+    assert core.tune_pool_size(3, 1, 1.5, 1.0, 1, 8) == (4, 1), "Improvement keeps direction"
+    assert core.tune_pool_size(4, 1, 1.2, 1.5, 1, 8) == (3, -1), "Regression is undone"
+    assert core.tune_pool_size(3, -1, 1.51, 1.5, 1, 8) == (3, 0), "Plateau holds"
+    assert core.tune_pool_size(8, 1, 2.0, 1.0, 1, 8) == (8, 0), "Bounded by hi"
+    return True
+
+
+# ============================================================================
+# AXIAL (Z) REGISTRATION
+# ============================================================================
+
+def _focus_profile(nz, peak, w=400, h=300, grid=4):
+    """Synthetic profile: every cell in focus around plane `peak`"""
+    curve = [100.0 / (1.0 + (z - peak) ** 2 / 9.0) for z in range(nz)]
+    cells = grid * grid
+    return {'grid': grid, 'w': w, 'h': h, 'nz': nz,
+            'sharp': [list(curve) for _ in range(cells)],
+            'mean': [[c * 0.5 + 10.0 for c in curve] for _ in range(cells)]}
+
+
+def test_axial_shift_and_pairs():
+    """Profiles shifted by 3 planes give a pair shift of +3"""
+    a = _focus_profile(34, 15.0)
+    b = _focus_profile(34, 12.0)  # b's focus plane 12 matches a's plane 15
+    d, score = core.axial_shift(a['sharp'][0], b['sharp'][0], 10)
+    assert abs(d - 3.0) < 0.05 and score > 0.99, "Got d=%r score=%r" % (d, score)
+
+    pairs = core.pair_axial_shifts([(0, 0), (300, 0), (2000, 0)], [a, b, _focus_profile(34, 15.0)], 10)
+    assert len(pairs) == 1, "Only tiles 0 and 1 overlap, got %r" % pairs
+    i, j, d, _ = pairs[0]
+    assert (i, j) == (0, 1) and abs(d - 3.0) < 0.05
+    return True
+
+
+def test_informative_z_range():
+    """Blank top/bottom planes are trimmed across tiles and z offsets, with a margin"""
+    blank, structure = 2.0, 40.0
+    a = [[blank] * 3 + [structure] * 4 + [blank] * 5]  # Planes 3..6
+    b = [[blank] * 5 + [structure] * 3 + [blank] * 4]  # Planes 5..7, offset by 2
+    assert core.informative_z_range([a, b], [0.0, 0.0], [12, 12], 0) == (3, 7, 12)
+    assert core.informative_z_range([a, b], [0.0, 2.4], [12, 12], 1) == (2, 10, 14)
+    assert core.informative_z_range([a, b], [0.0, 0.0], [12, 12], 5) == (0, 11, 12), "Margin is clamped"
+    glass = [[30.0] * 12]
+    assert core.informative_z_range([a, None], [0.0, -3.0], [12, 12], 0) == (6, 9, 15), "Unscored tiles add extent"
+    assert core.informative_z_range([glass], [0.0], [12], 0) is None, "Flat: nothing to tell apart"
+    dim = [[30.0, 31.0, 35.0, 40.0, 38.0, 32.0]]
+    assert core.informative_z_range([dim], [0.0], [6], 0) == (0, 5, 6), "Contrast everywhere is kept"
+    assert core.z_trim_note(3, 7, 12) == u"ZTrim = planes 4-8 of 12 kept"
+    return True
+
+
+def test_solve_z_offsets():
+    """Chained shifts accumulate, outliers and unlinked tiles are handled"""
+    pairs = [(0, 1, 2.0, 0.9), (1, 2, -1.0, 0.9), (0, 2, 1.0, 0.8), (2, 3, 9.0, 0.6), (1, 3, 0.0, 0.9),
+             (0, 3, 0.0, 0.9)]
+    z, used = core.solve_z_offsets(5, pairs)
+    assert abs(z[0]) < 1e-9
+    assert abs(z[1] - 2.0) < 0.01 and abs(z[2] - 1.0) < 0.01, "Got %r" % z
+    assert (2, 3, 9.0, 0.6) not in used, "Outlier pair must be dropped"
+    assert z[4] == 0.0, "Unlinked tile stays at 0"
+    assert core.solve_z_offsets(0, []) == ([], [])
+    return True
+
+
+# ============================================================================
+# CZI SUBBLOCK DIRECTORY
+# ============================================================================
+
+def _segment(name, data):
+    return name.encode('ascii').ljust(16, b'\x00') + struct.pack('<qq', len(data), len(data)) + data
+
+
+def _dir_entry(pos, dims, pyramid=0, compression=0):
+    head = b'DV' + struct.pack('<iqii', 1, pos, 0, compression) + struct.pack('<B', pyramid) + b'\x00' * 5
+    head += struct.pack('<i', len(dims))
+    for name, start, size, stored in dims:
+        head += name.encode('ascii').ljust(4, b'\x00') + struct.pack('<iifi', start, size, 0.0, stored)
+    return head
+
+
+def _write_czi(path, planes):
+    """Uncompressed Gray16 CZI; planes = [(m, c, z, pixels_bytes)], 2x2 px"""
+    blob = b''
+    entries = []
+    pos = 32 + 512
+    for m, c, z, pixels in planes:
+        dims = [('X', 0, 2, 2), ('Y', 0, 2, 2), ('C', c, 1, 1), ('Z', z, 1, 1), ('M', m, 1, 1)]
+        entry = _dir_entry(pos, dims)
+        meta = b'<METADATA/>'
+        body = struct.pack('<iiq', len(meta), 0, len(pixels)) + entry
+        body = body.ljust(256, b'\x00') + meta + pixels
+        seg = _segment('ZISRAWSUBBLOCK', body)
+        blob += seg
+        entries.append(entry)
+        pos += len(seg)
+    # a downscaled pyramid subblock must not show up as a tile
+    entries.append(_dir_entry(pos, [('X', 0, 4, 2), ('Y', 0, 4, 2), ('M', 0, 1, 1)], pyramid=1))
+    directory = _segment('ZISRAWDIRECTORY', struct.pack('<i', len(entries)) + b'\x00' * 124 + b''.join(entries))
+    header = struct.pack('<iiii', 1, 0, 0, 0) + b'\x00' * 32 + struct.pack('<iqqiq', 0, pos, 0, 0, 0)
+    with open(path, 'wb') as f:
+        f.write(_segment('ZISRAWFILE', header).ljust(32 + 512, b'\x00'))
+        f.write(blob)
+        f.write(directory)
+
+
+def test_czi_directory_and_subblocks():
+    """Directory entries are grouped per tile and point at the pixel data"""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "synthetic.czi")
+        planes = [(1, 0, 0, b'\x01\x00' * 4), (0, 1, 0, b'\x02\x00' * 4), (0, 0, 0, b'\x03\x00' * 4),
+                  (1, 1, 0, b'\x04\x00' * 4)]
+        _write_czi(path, planes)
+        entries = core.read_czi_directory(path)
+        assert len(entries) == 5
+        tiles = core.czi_tile_planes(entries)
+        assert len(tiles) == 2, "Pyramid level must be skipped"
+        assert sorted(tiles[0].keys()) == [(0, 0, 0), (1, 0, 0)]
+        with open(path, 'rb') as f:
+            e = tiles[1][(1, 0, 0)]
+            f.seek(e['file_position'])
+            offset, length = core.czi_subblock_data_range(e, f.read(core.CZI_SUBBLOCK_PREFIX))
+            f.seek(offset)
+            assert f.read(length) == b'\x04\x00' * 4
+        assert core.czi_is_complete(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+        truncated = os.path.join(tmp, "writing.czi")
+        with open(truncated, 'wb') as f:
+            f.write(data[:-40])
+        assert not core.czi_is_complete(truncated), "Directory not fully written yet"
+        assert not core.czi_is_complete(os.path.join(SAMPLES, "OME.xml"))
+        assert core.czi_zstd1_header(b'\x03\x01\x01payload') == (3, True)
+        assert core.czi_zstd1_header(b'\x01payload') == (1, False)
+        try:
+            core.read_czi_directory(os.path.join(SAMPLES, "OME.xml"))
+            assert False, "Non-CZI input must raise"
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(tmp)
+    return True
+
+
+# ============================================================================
+# TEST RUNNER
+# ============================================================================
+
+def run_all_tests():
+    """Run all tests and report results"""
+    print("\n" + "="*70)
+    print("STITCHER CORE - TEST SUITE")
+    print("="*70)
+
+    tests = [
+        test_stage_labels_from_sample_xml,
+        test_stage_label_lookup_reuses_parsed_labels,
+        test_pixel_size_and_channel_colors,
+        test_pixel_from_global_metadata,
+        test_unit_conversion,
+        test_tile_configuration_roundtrip,
+        test_fallback_uses_neighbor_error,
+        test_fallback_without_prediction_stays_failed,
+        test_attach_predictions,
+        test_subset_spec_parsing,
+        test_roi_tile_selection_and_plane_clamping,
+        test_plane_ranges_outside_the_stack,
+        test_timelapse_helpers,
+        test_display_range_from_streamed_histograms,
+        test_scene_parsing_and_grouping,
+        test_tile_worker_budget,
+        test_files_to_stage,
+        test_staged_subset_sidecar,
+        test_stage_cache_roundtrip_and_lru,
+        test_settled_files,
+        test_job_spool_roundtrip,
+        test_background_tiles,
+        test_virtual_mosaic,
+        test_pipeline_tuning,
+        test_axial_shift_and_pairs,
+        test_solve_z_offsets,
+        test_informative_z_range,
+        test_czi_directory_and_subblocks
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        try:
+            if test():
+                passed += 1
+            else:
+                failed += 1
+                print("[FAIL] %s FAILED" % test.__name__)
+        except Exception as e:
+            failed += 1
+            print("[FAIL] %s EXCEPTION: %s" % (test.__name__, str(e)))
+            import traceback
+            traceback.print_exc()
+
+    print("\n" + "="*70)
+    print("TEST RESULTS: %d passed, %d failed" % (passed, failed))
+    print("="*70)
+
+    return failed == 0
+
+
+if __name__ == '__main__':
+    success = run_all_tests()
+    sys.exit(0 if success else 1)